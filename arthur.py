@@ -1,88 +1,2425 @@
 #!/usr/bin/env python
-from opster import help_cmd
-from opster import dispatch
-import urllib
-import urllib2
-import urlparse
-import json
 import sys
-import curses
+import time
+import __builtin__
+
+
+class ImportTimer(object):
+    """``__import__`` hook timing the first import of every module
+
+    Installed by ``--profile-startup``. The report lists modules in import
+    order, indented below the module importing them, with the time spent
+    in each excluding and including its own imports.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.ready = None
+        self.records = []
+        self.stack = []
+        self.original = __builtin__.__import__
+
+    def install(self):
+        __builtin__.__import__ = self
+
+    def __call__(self, name, globals=None, locals=None, fromlist=None,
+                 level=-1):
+        loaded = len(sys.modules)
+        # name, depth, started, total, time in nested imports
+        record = [name, len(self.stack), time.time(), 0.0, 0.0]
+        self.stack.append(record)
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            self.stack.pop()
+            record[3] = time.time() - record[2]
+            if len(sys.modules) > loaded:
+                self.records.append(record)
+                if self.stack:
+                    self.stack[-1][4] += record[3]
+
+    def report(self, out=sys.stderr):
+        out.write('%9s %9s  module\n' % ('self ms', 'total ms'))
+        records = sorted(self.records, key=lambda record: record[2])
+        for name, depth, started, total, nested in records:
+            if self.ready and started >= self.ready:
+                out.write('startup: %.1f ms; then imported by the command:\n'
+                          % ((self.ready - self.start) * 1e3))
+                self.ready = None
+            out.write('%9.1f %9.1f  %s%s\n' % ((total - nested) * 1e3,
+                                               total * 1e3, '  ' * depth,
+                                               name))
+        if self.ready:
+            out.write('startup: %.1f ms\n' % ((self.ready - self.start) * 1e3))
+
+import_timer = None
+if __name__ == '__main__' and '--profile-startup' in sys.argv:
+    import_timer = ImportTimer()
+    import_timer.install()
+
+import importlib
+import marshal
+import zlib
+import urlparse
+import errno
 import os.path
 from os.path import join
-import glob
-import shutil
-import tarfile
 import re
 from itertools import chain
-import subprocess
-import tempfile
-from subprocess import Popen
-from subprocess import PIPE
+import threading
+import Queue
+import fcntl
+import bisect
+import heapq
+import math
+from collections import namedtuple
+from contextlib import closing
+
+
+class LazyModule(object):
+    """Stand-in for a module that is only imported once it is used
+
+    The first attribute lookup imports the module and rebinds the global
+    name to it, so later lookups do not go through the stand-in.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+# each command only imports what it uses; completion in particular must
+# stay cheap
+opster = LazyModule('opster')
+json = LazyModule('json')
+glob = LazyModule('glob')
+shutil = LazyModule('shutil')
+subprocess = LazyModule('subprocess')
+tempfile = LazyModule('tempfile')
+hashlib = LazyModule('hashlib')
+platform = LazyModule('platform')
+urllib = LazyModule('urllib')
+httplib = LazyModule('httplib')
+socket = LazyModule('socket')
+tarfile = LazyModule('tarfile')
+sqlite3 = LazyModule('sqlite3')
+select = LazyModule('select')
+ssl = LazyModule('ssl')
+cStringIO = LazyModule('cStringIO')
+shlex = LazyModule('shlex')
+traceback = LazyModule('traceback')
+
+
+class LazyPattern(object):
+    """Regular expression compiled the first time it is used"""
+
+    def __init__(self, pattern, flags=0):
+        self.__dict__['_args'] = (pattern, flags)
+
+    def __getattr__(self, attr):
+        # keep the compiled pattern's bound methods so later calls go
+        # straight to them
+        value = getattr(re.compile(*self._args), attr)
+        self.__dict__[attr] = value
+        return value
+
+
+class Span(object):
+    """Timed region of a Tracer; returned by ``span``"""
+
+    __slots__ = ('tracer', 'name', 'args', 'started', 'nested')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.nested = 0.0
+
+    def __enter__(self):
+        self.tracer.stack().append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.started
+        stack = self.tracer.stack()
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.tracer.record(self, elapsed)
+
+
+class NoSpan(object):
+    """What ``span`` returns while nothing is traced"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Tracer(object):
+    """Timing spans and counters of one command, enabled by ``--trace``
+
+    Spans nest within each thread. ``summary`` lists every span name with
+    its calls and its time including and excluding the spans nested in it,
+    then the counters; ``chrome`` writes everything as Chrome trace events
+    for chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # name, thread, started, total, self time, args
+        self.spans = []
+        self.counters = {}
+        # name, time, value after the change
+        self.samples = []
+
+    def stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def record(self, span, elapsed):
+        thread = threading.current_thread()
+        with self.lock:
+            self.spans.append((span.name, (thread.ident, thread.name),
+                               span.started, elapsed, elapsed - span.nested,
+                               span.args))
+
+    def count(self, name, n):
+        with self.lock:
+            value = self.counters[name] = self.counters.get(name, 0) + n
+            self.samples.append((name, time.time(), value))
+
+    def summary(self, out=sys.stderr):
+        totals = {}
+        for name, thread, started, total, own, args in self.spans:
+            calls, all_time, self_time = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (calls + 1, all_time + total, self_time + own)
+        out.write('%7s %10s %10s  span\n' % ('calls', 'total ms', 'self ms'))
+        for name, (calls, total, own) in sorted(
+                totals.iteritems(), key=lambda item: -item[1][1]):
+            out.write('%7d %10.1f %10.1f  %s\n' % (calls, total * 1e3,
+                                                   own * 1e3, name))
+        if self.counters:
+            out.write('%18s  counter\n' % 'count')
+            for name in sorted(self.counters):
+                out.write('%18d  %s\n' % (self.counters[name], name))
+
+    def chrome(self, out):
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for name, (tid, thread), started, total, own, args in self.spans:
+            threads[tid] = thread
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (started - self.start) * 1e6,
+                           'dur': total * 1e6, 'args': args})
+        for name, when, value in self.samples:
+            events.append({'name': name, 'ph': 'C', 'pid': pid,
+                           'ts': (when - self.start) * 1e6,
+                           'args': {name: value}})
+        for tid, thread in threads.iteritems():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': thread}})
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+
+tracer = None
+_no_span = NoSpan()
+
+def span(name, **args):
+    """Return a context manager timing name while tracing"""
+    if tracer is None:
+        return _no_span
+    return Span(tracer, name, args)
+
+def tally(name, n=1):
+    """Add n to the counter name while tracing"""
+    if tracer is not None:
+        tracer.count(name, n)
+
+
+_colour_map = None
+
+def colour_map():
+    """Return the escape sequences of the terminal, looked up once
+
+    They are empty when $TERM names no terminal with colours.
+    """
+    global _colour_map
+    if _colour_map is None:
+        import curses
+
+        # sys.stdout may be a stream of arthur serve, without a descriptor
+        try:
+            curses.setupterm(fd=sys.__stdout__.fileno())
+            fg = curses.tigetstr('setaf')
+            bg = curses.tigetstr('setab')
+        except curses.error:
+            fg = bg = None
+        cmap = {}
+        for color in "BLUE GREEN CYAN RED MAGENTA YELLOW WHITE BLACK".split():
+            index = getattr(curses, 'COLOR_%s' % color)
+            cmap[color] = curses.tparm(fg, index) if fg else ''
+            cmap['BG_%s' % color] = curses.tparm(bg, index) if bg else ''
+        for name, cap in [('NORMAL', 'sgr0'), ('BG_NORMAL', 'sgr0'),
+                          ('BOLD', 'bold')]:
+            cmap[name] = (curses.tigetstr(cap) or '') if fg else ''
+        _colour_map = cmap
+    return _colour_map
+
+
+class OutputFormatter(object):
+    """Style the output of a command
+
+    Output is collected in a buffer and written to ``stream`` (stdout by
+    default) in large chunks; call flush() when done. Colours are only used
+    when the stream is a terminal, unless ``colour`` says otherwise, and the
+    terminal is only set up once the first coloured line is written.
+    """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, stream=None, colour=None):
+        import textwrap
+
+        self.stream = stream
+        self.colour = colour
+        self.wrapper = textwrap.TextWrapper()
+        self.buffer = []
+        self.size = 0
+        self.prefixes = {}
+
+    def prefix(self, fg, bg, style):
+        """Return the escape sequence that starts a line, or None"""
+        key = (fg, bg, style)
+        if key not in self.prefixes:
+            if self.colour is None:
+                stream = self.stream or sys.stdout
+                self.colour = hasattr(stream, 'isatty') and stream.isatty()
+            prefix = None
+            if self.colour and fg:
+                cmap = colour_map()
+                bg = 'BG_%s' % bg if bg else 'BG_NORMAL'
+                try:
+                    prefix = '%s%s%s' % (cmap[bg.upper()],
+                                         cmap.get(style.upper(), style),
+                                         cmap[fg.upper()])
+                except KeyError:
+                    pass
+            self.prefixes[key] = prefix
+        return self.prefixes[key]
+
+    def lines(self, str, indent, subsequent_indent):
+        # wrapping is costly and most lines need none: skip it for lines
+        # that are short enough and have no whitespace to normalise
+        if (len(str) + len(indent) <= self.wrapper.width and str and
+                str == str.strip() and '  ' not in str and
+                '\t' not in str and '\n' not in str):
+            return [indent + str]
+        self.wrapper.initial_indent = indent
+        self.wrapper.subsequent_indent = subsequent_indent
+        return self.wrapper.wrap(str)
+
+    def __call__(self, str, indent='', subsequent_indent=None, fg=None,
+                 bg=None, separator='\n', style=''):
+        if subsequent_indent is None:
+            subsequent_indent = indent
+        prefix = self.prefix(fg, bg, style)
+        for line in self.lines(str, indent, subsequent_indent):
+            if isinstance(line, unicode):
+                line = line.encode('utf8')
+            if prefix is not None:
+                line = '%s%s%s' % (prefix, line, colour_map()['NORMAL'])
+            self.write(line + separator)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        try:
+            (self.stream or sys.stdout).write(data)
+            (self.stream or sys.stdout).flush()
+        except IOError, e:
+            # the reader went away (e.g. piped into head); stop quietly
+            if e.errno != errno.EPIPE:
+                raise
+            sys.exit(1)
+
+def dependency_name(dep):
+    """Strip the version constraint from a dependency like ``foo>=1.0``"""
+    return re.split('[=<>]', dep, 1)[0]
+
+def package_file_name(path):
+    """Return the pkgname of a package file like
+    ``foo-1.0-1-x86_64.pkg.tar.zst``"""
+    return os.path.basename(path).rsplit('-', 3)[0]
+
+_digits = frozenset('0123456789')
+_letters = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+_alnum = _digits | _letters
+
+def rpmvercmp(a, b):
+    """Compare two version strings segment by segment like rpm does"""
+    if a == b:
+        return 0
+    one = two = 0
+    end1, end2 = len(a), len(b)
+    while one < end1 and two < end2:
+        start1, start2 = one, two
+        while one < end1 and a[one] not in _alnum:
+            one += 1
+        while two < end2 and b[two] not in _alnum:
+            two += 1
+        if one == end1 or two == end2:
+            break
+        # a longer separator makes a newer version
+        if one - start1 != two - start2:
+            return -1 if one - start1 < two - start2 else 1
+        chars = _digits if a[one] in _digits else _letters
+        ptr1, ptr2 = one, two
+        while ptr1 < end1 and a[ptr1] in chars:
+            ptr1 += 1
+        while ptr2 < end2 and b[ptr2] in chars:
+            ptr2 += 1
+        if ptr2 == two:
+            # numeric segments are newer than alphabetic ones
+            return 1 if chars is _digits else -1
+        seg1, seg2 = a[one:ptr1], b[two:ptr2]
+        if chars is _digits:
+            seg1 = seg1.lstrip('0')
+            seg2 = seg2.lstrip('0')
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+        if seg1 != seg2:
+            return 1 if seg1 > seg2 else -1
+        one, two = ptr1, ptr2
+    if one == end1 and two == end2:
+        return 0
+    # a remaining alphabetic segment never beats the end of the string
+    if (one == end1 and not (b[two] in _letters)) or (
+            one < end1 and a[one] in _letters):
+        return -1
+    return 1
+
+def parse_evr(version):
+    """Split ``epoch:pkgver-pkgrel`` into its parts; the epoch defaults to
+    0 and the pkgrel to None"""
+    i = 0
+    while i < len(version) and version[i] in _digits:
+        i += 1
+    epoch = '0'
+    if version[i:i + 1] == ':':
+        epoch = version[:i] or '0'
+        version = version[i + 1:]
+    pkgver, sep, pkgrel = version.rpartition('-')
+    if not sep:
+        return epoch, version, None
+    return epoch, pkgver, pkgrel
+
+_vercmp_cache = {}
+
+def vercmp(a, b):
+    """Compare package versions like pacman's vercmp: return -1, 0 or 1
+    when a is older than, the same as or newer than b
+
+    The cases of pacman's vercmp test suite, each checked both ways:
+
+    >>> cases = '''
+    ... 1.5.0 1.5.0 0
+    ... 1.5.1 1.5.0 1
+    ... 1.5.1 1.5 1
+    ... 1.5.0-1 1.5.0-1 0
+    ... 1.5.0-1 1.5.0-2 -1
+    ... 1.5.0-1 1.5.1-1 -1
+    ... 1.5.0-2 1.5.1-1 -1
+    ... 1.5-1 1.5.1-1 -1
+    ... 1.5-2 1.5.1-1 -1
+    ... 1.5-2 1.5.1-2 -1
+    ... 1.5 1.5-1 0
+    ... 1.5-1 1.5 0
+    ... 1.1-1 1.1 0
+    ... 1.0-1 1.1 -1
+    ... 1.1-1 1.0 1
+    ... 1.5b-1 1.5-1 -1
+    ... 1.5b 1.5 -1
+    ... 1.5b-1 1.5 -1
+    ... 1.5b 1.5.1 -1
+    ... 1.0a 1.0alpha -1
+    ... 1.0alpha 1.0b -1
+    ... 1.0b 1.0beta -1
+    ... 1.0beta 1.0rc -1
+    ... 1.0rc 1.0 -1
+    ... 1.5.a 1.5 1
+    ... 1.5.b 1.5.a 1
+    ... 1.5.1 1.5.b 1
+    ... 1.5.b-1 1.5.b 0
+    ... 1.5-1 1.5.b -1
+    ... 2.0 2_0 0
+    ... 2.0_a 2_0.a 0
+    ... 2.0a 2.0.a -1
+    ... 2___a 2_a 1
+    ... 0:1.0 0:1.0 0
+    ... 0:1.0 0:1.1 -1
+    ... 1:1.0 0:1.0 1
+    ... 1:1.0 0:1.1 1
+    ... 1:1.0 2:1.1 -1
+    ... 1:1.0 0:1.0-1 1
+    ... 1:1.0-1 0:1.1-1 1
+    ... 0:1.0 1.0 0
+    ... 0:1.0 1.1 -1
+    ... 0:1.1 1.0 1
+    ... 1:1.0 1.0 1
+    ... 1:1.0 1.1 1
+    ... 1:1.1 1.1 1'''
+    >>> words = cases.split()
+    >>> for a, b, expected in zip(words[::3], words[1::3], words[2::3]):
+    ...     for x, y, e in ((a, b, int(expected)), (b, a, -int(expected))):
+    ...         if vercmp(x, y) != e:
+    ...             print x, y, vercmp(x, y)
+    """
+    key = (a, b)
+    if key not in _vercmp_cache:
+        if a == b:
+            result = 0
+        else:
+            epoch1, pkgver1, pkgrel1 = parse_evr(a)
+            epoch2, pkgver2, pkgrel2 = parse_evr(b)
+            result = (rpmvercmp(epoch1, epoch2) or
+                      rpmvercmp(pkgver1, pkgver2))
+            if not result and pkgrel1 is not None and pkgrel2 is not None:
+                result = rpmvercmp(pkgrel1, pkgrel2)
+        if len(_vercmp_cache) > 100000:
+            _vercmp_cache.clear()  # a long running serve
+        _vercmp_cache[key] = result
+    return _vercmp_cache[key]
+
+def pacman_query(*args):
+    """Run pacman with args and return its output"""
+    env = dict(os.environ, LC_ALL='C')
+    tally('subprocesses')
+    with span('pacman_query', args=' '.join(args)):
+        try:
+            proc = subprocess.Popen(('pacman',) + args,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=env)
+        except OSError, e:
+            raise ArthurError('pacman: %s' % e.strerror)
+        out, error = proc.communicate()
+    return out
+
+
+class PacmanState(object):
+    """Snapshot of the installed packages and of what the repos offer
+
+    Taken with a single ``pacman -Qi`` and a single ``pacman -Sl`` instead
+    of querying pacman once per dependency.
+    """
+
+    def __init__(self):
+        self.installed = {}
+        self.provided = {}
+        self.available = {}
+
+    def load(self):
+        with span('pacman state'):
+            return self._load()
+
+    def _load(self):
+        for block in pacman_query('-Qi').split('\n\n'):
+            fields = {}
+            for line in block.splitlines():
+                key, sep, value = line.partition(' : ')
+                if sep:
+                    fields[key.strip()] = value.strip()
+            if 'Name' not in fields:
+                continue
+            self.installed[fields['Name']] = fields.get('Version')
+            for provide in fields.get('Provides', 'None').split():
+                if provide != 'None':
+                    self.provided.setdefault(dependency_name(provide),
+                                             fields['Name'])
+        for line in pacman_query('-Sl').splitlines():
+            parts = line.split()
+            if len(parts) >= 3:
+                self.available.setdefault(parts[1], (parts[0], parts[2]))
+        return self
+
+    def is_installed(self, pkg):
+        return pkg in self.installed or pkg in self.provided
+
+    def in_repo(self, pkg):
+        return pkg in self.available
+
+def unique(items):
+    """Return items without duplicates, keeping the first occurrence"""
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+def pool_map(func, items, jobs):
+    """Like map() but call func on at most jobs threads at once"""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for pair in enumerate(items):
+        queue.put(pair)
+
+    def worker():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except BaseException:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max(1, jobs), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout so that ^C still reaches the main thread
+        while thread.is_alive():
+            thread.join(0.1)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def cache_dir(*parts):
+    """Return a directory below the XDG cache directory, creating it"""
+    base = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = join(base, 'arthur', *parts)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+class ResponseCache(object):
+    """On-disk cache of rpc responses keyed by request url
+
+    Every entry is a ``<key>.body`` file with the response and a
+    ``<key>.json`` file with its url, validators, storage time and ttl. The
+    modification time of the json file records the last access; the least
+    recently used entries are evicted once the cache outgrows ``max_size``.
+    """
+
+    # seconds an entry is served without revalidation, by rpc type
+    ttls = {'search': 3600, 'info': 900, 'multiinfo': 900}
+    default_ttl = 900
+
+    def __init__(self, path=None, max_size=32 * 1024 * 1024):
+        self._path = path
+        self.max_size = max_size
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = cache_dir('rpc')
+        return self._path
+
+    def key(self, url):
+        return join(self.path, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """Return the entry for url, or None, and mark it as used"""
+        key = self.key(url)
+        try:
+            entry = json.load(open(key + '.json'))
+            os.utime(key + '.json', None)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('url') != url or not os.path.exists(key + '.body'):
+            return None
+        return entry
+
+    def fresh(self, entry):
+        return time.time() - entry['stored'] < entry['ttl']
+
+    def open(self, entry):
+        return open(self.key(entry['url']) + '.body', 'rb')
+
+    def ttl(self, url, headers):
+        for directive in (headers.get('cache-control') or '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'max-age' and value.isdigit():
+                return int(value)
+        query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+        return self.ttls.get(query.get('type', [''])[0], self.default_ttl)
+
+    def reader(self, url, response, headers):
+        """Wrap a response so that its body is stored once it has been read
+        to the end, along with the validators from its headers"""
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+        except (IOError, OSError):
+            # an unwritable cache only costs us the network round-trip
+            return response
+        copy = os.fdopen(fd, 'wb')
+
+        def store():
+            copy.close()
+            self.store(url, tmp, headers)
+        return Tee(response, copy, store)
+
+    def store(self, url, tmp, headers):
+        """Move a response body written to tmp into the cache"""
+        entry = {'url': url, 'stored': time.time(),
+                 'ttl': self.ttl(url, headers),
+                 'etag': headers.get('etag'),
+                 'last_modified': headers.get('last-modified')}
+        key = self.key(url)
+        try:
+            os.rename(tmp, key + '.body')
+            self._write(key + '.json', json.dumps(entry))
+        except (IOError, OSError):
+            return
+        self.evict()
+
+    def revalidated(self, entry, headers):
+        """Restart the ttl of an entry the server reported unchanged"""
+        entry['stored'] = time.time()
+        entry['ttl'] = self.ttl(entry['url'], headers)
+        try:
+            self._write(self.key(entry['url']) + '.json', json.dumps(entry))
+        except (IOError, OSError):
+            pass
+
+    def _write(self, path, data):
+        # write then rename so readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits max_size"""
+        entries = []
+        total = 0
+        for meta in glob.glob(join(self.path, '*.json')):
+            body = meta[:-len('.json')] + '.body'
+            try:
+                size = os.path.getsize(meta) + os.path.getsize(body)
+                used = os.path.getmtime(meta)
+            except OSError:
+                continue
+            entries.append((used, meta, body, size))
+            total += size
+        # bodies of responses that were never read to the end
+        for tmp in glob.glob(join(self.path, 'tmp*')):
+            try:
+                if os.path.getmtime(tmp) < time.time() - 3600:
+                    os.remove(tmp)
+            except OSError:
+                pass
+        entries.sort()
+        while total > self.max_size and entries:
+            used, meta, body, size = entries.pop(0)
+            for path in (meta, body):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+def parse_desc(text):
+    """Parse a pacman ``desc``/``depends`` file into a dict of lists"""
+    fields = {}
+    for block in text.split('\n\n'):
+        lines = block.strip().splitlines()
+        if lines and lines[0].startswith('%') and lines[0].endswith('%'):
+            fields[lines[0].strip('%')] = lines[1:]
+    return fields
+
+
+class SyncIndex(object):
+    """Name lookups over the pacman sync databases
+
+    The databases are read either from the ``<repo>.db`` tarballs or from
+    the older one-directory-per-package layout. Parsed databases are cached
+    on disk and only parsed again when the database's mtime changes.
+    """
+
+    # repos searched first, in this order; any others follow alphabetically
+    repos = ['core', 'community', 'extra']
+
+    def __init__(self, root='/var/lib/pacman/sync', cache=None):
+        self.root = root
+        self.cache = cache
+        self.packages = {}
+        self.providers = {}
+
+    def sources(self):
+        """Return (repo, path) of every database below root"""
+        found = {}
+        for path in glob.glob(join(self.root, '*')):
+            name = os.path.basename(path)
+            if os.path.isdir(path):
+                found.setdefault(name, path)
+            elif name.endswith('.db'):
+                found[name[:-len('.db')]] = path
+        order = [r for r in self.repos if r in found]
+        order += sorted(r for r in found if r not in self.repos)
+        return [(repo, found[repo]) for repo in order]
+
+    def load(self):
+        """Read every database, reusing cached ones that did not change"""
+        if self.cache is None:
+            self.cache = join(cache_dir(), 'syncdb.json')
+        try:
+            cached = json.load(open(self.cache))
+        except (IOError, OSError, ValueError):
+            cached = {}
+        databases = {}
+        for repo, path in self.sources():
+            mtime = os.path.getmtime(path)
+            entry = cached.get(path)
+            if not entry or entry['mtime'] != mtime:
+                entry = {'mtime': mtime, 'packages': self.read(path)}
+            databases[path] = entry
+            self.add(repo, entry['packages'])
+        if databases != cached:
+            try:
+                with open(self.cache, 'w') as f:
+                    json.dump(databases, f)
+            except (IOError, OSError):
+                pass
+        return self
+
+    def add(self, repo, packages):
+        for name, (version, provides) in packages.iteritems():
+            if name in self.packages:
+                continue
+            self.packages[name] = (repo, version, provides)
+            for provide in provides:
+                self.providers.setdefault(provide, name)
+
+    def read(self, path):
+        """Return {name: [version, provides]} for one database"""
+        packages = {}
+        if os.path.isdir(path):
+            for pkgdir in glob.glob(join(path, '*')):
+                fields = {}
+                for member in ('desc', 'depends'):
+                    try:
+                        fields.update(parse_desc(open(join(pkgdir,
+                                                           member)).read()))
+                    except IOError:
+                        pass
+                self._record(packages, fields)
+        else:
+            db = tarfile.open(path)
+            entries = {}
+            for member in db:
+                pkgdir, _, member_name = member.name.rpartition('/')
+                if member.isfile() and member_name in ('desc', 'depends'):
+                    text = db.extractfile(member).read()
+                    entries.setdefault(pkgdir, {}).update(parse_desc(text))
+            db.close()
+            for fields in entries.itervalues():
+                self._record(packages, fields)
+        return packages
+
+    def _record(self, packages, fields):
+        if fields.get('NAME'):
+            provides = [dependency_name(p) for p in fields.get('PROVIDES', [])]
+            packages[fields['NAME'][0]] = [(fields.get('VERSION') or [''])[0],
+                                           provides]
+
+    def lookup(self, name):
+        """Return (repo, version, provides) of name or of its provider"""
+        if name not in self.packages:
+            name = self.providers.get(name)
+        return self.packages.get(name)
+
+
+_sync_indexes = {}
+_sync_lock = threading.Lock()
+
+def sync_index(root='/var/lib/pacman/sync'):
+    """Return the SyncIndex of root, loading it once per process"""
+    with _sync_lock:
+        if root not in _sync_indexes:
+            with span('sync index load'):
+                _sync_indexes[root] = SyncIndex(root).load()
+        return _sync_indexes[root]
+
+
+# leading bytes of the compression formats source tarballs come in
+compressions = [('\x1f\x8b', 'gz'), ('BZh', 'bz2'),
+                ('\xfd7zXZ\x00', 'xz'), ('\x28\xb5\x2f\xfd', 'zst')]
+# tarfile cannot decompress these itself, so they go through a filter
+decompressors = {'xz': ['xz', '-dc'], 'zst': ['zstd', '-dc']}
+
+
+class Tee(object):
+    """File-like reader that copies everything it reads to ``copy`` and
+    calls ``done``, if given, once it has read to the end"""
+
+    def __init__(self, fileobj, copy, done=None):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.done = done
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        if self.done and (not data or size < 0):
+            done, self.done = self.done, None
+            done()
+        return data
+
+
+class Prefixed(object):
+    """File-like reader that replays ``head`` before reading on"""
+
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+        if size < 0:
+            data, self.head = self.head + self.fileobj.read(), ''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+
+class Gunzip(object):
+    """File-like reader that inflates a gzip stream as it is read"""
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self.buffer += self.inflate.flush()
+                break
+            self.buffer += self.inflate.decompress(data)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def open_dump(fileobj):
+    """Return a reader of a package dump that may be gzip compressed"""
+    head = fileobj.read(2)
+    fileobj = Prefixed(head, fileobj)
+    return Gunzip(fileobj) if head == '\x1f\x8b' else fileobj
+
+
+def open_tarball(fileobj):
+    """Open a possibly compressed tarball for reading as a stream
+
+    Returns the TarFile and the filter process decompressing for it, if any.
+    """
+    head = fileobj.read(6)
+    fileobj = Prefixed(head, fileobj)
+    compression = ''
+    for magic, name in compressions:
+        if head.startswith(magic):
+            compression = name
+    if compression not in decompressors:
+        return tarfile.open(fileobj=fileobj, mode='r|' + compression), None
+
+    try:
+        tally('subprocesses')
+        proc = subprocess.Popen(decompressors[compression],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError, e:
+        raise ArthurError('%s: %s' % (decompressors[compression][0],
+                                      e.strerror))
+
+    def feed():
+        try:
+            shutil.copyfileobj(fileobj, proc.stdin)
+        except IOError:
+            pass
+        finally:
+            proc.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    return tarfile.open(fileobj=proc.stdout, mode='r|'), proc
+
+
+def read_members(fileobj, names=('PKGBUILD', '.SRCINFO')):
+    """Read top level files of a source tarball from a stream
+
+    Returns a dict mapping each of ``names`` found in the tarball to its
+    contents. Only those members are read into memory and nothing is written
+    to disk; the whole stream is consumed so it can be teed to a file.
+    """
+    found = {}
+    tar, proc = open_tarball(fileobj)
+    for member in tar:
+        # normpath drops a leading ./ without touching .SRCINFO
+        parts = os.path.normpath(member.name).lstrip('/').split('/')
+        if (member.isfile() and len(parts) <= 2 and parts[-1] in names
+                and parts[-1] not in found):
+            found[parts[-1]] = tar.extractfile(member).read()
+    tar.close()
+    if proc:
+        proc.stdout.read()
+        proc.wait()
+    else:
+        # read past the end-of-archive blocks and compression trailer
+        while fileobj.read(16 * 1024):
+            pass
+    return found
+
+
+def unpack(fileobj, dest):
+    """Extract a possibly compressed tarball stream below dest
+
+    Members with absolute paths or ``..`` components are skipped.
+    """
+    tar, proc = open_tarball(fileobj)
+    for member in tar:
+        parts = member.name.split('/')
+        if member.name.startswith('/') or '..' in parts:
+            continue
+        tar.extract(member, dest)
+    tar.close()
+    if proc:
+        proc.stdout.read()
+        proc.wait()
+
+
+Metadata = namedtuple('Metadata', 'name version depends makedepends '
+                                   'checkdepends provides conflicts')
+
+# arrays kept in Metadata; each may have an ``_<arch>`` variant
+metadata_arrays = ('depends', 'makedepends', 'checkdepends', 'provides',
+                   'conflicts')
+
+_pkgbuild_token = LazyPattern(r'''
+    ^[ \t]*(?P<name>[A-Za-z_][A-Za-z0-9_]*)(?P<append>\+?)=
+    | \\. | '[^']*' | "(?:\\.|[^"\\])*" | \$\{[^}]*\} | (?<![^\s(])\#[^\n]*
+    | (?P<open>\{) | (?P<close>\})
+''', re.M | re.S | re.X)
+_variable = LazyPattern(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)\}?')
+_word = LazyPattern(r'''(?<![^\s(])#[^\n]*|(?:\\.|'[^']*'|"(?:\\.|[^"\\])*"|[^\s'"\\])+''',
+                    re.S)
+_quoting = LazyPattern(r'''\\(.)|'([^']*)'|"((?:\\.|[^"\\])*)"''', re.S)
+_scanners = {}
+_metadata = {}
+
+def _scan(text, i, stop):
+    """Return the index of the first char in stop at or after i that is not
+    quoted, escaped, commented out or part of a ``${...}`` expansion"""
+    scanner = _scanners.get(stop)
+    if scanner is None:
+        scanner = _scanners[stop] = re.compile(
+            r'''\\.|'[^']*'|"(?:\\.|[^"\\])*"|\$\{[^}]*\}|(?<![^\s(])#[^\n]*'''
+            r'|([%s])' % re.escape(stop), re.S)
+    for match in scanner.finditer(text, i):
+        if match.group(1) is not None:
+            return match.start()
+    return len(text)
+
+def _assignments(text):
+    """Yield (name, append, array, value) for each top level assignment of a
+    PKGBUILD, skipping those inside function bodies"""
+    text = text.replace('\\\n', ' ')
+    depth, pos = 0, 0
+    while True:
+        match = _pkgbuild_token.search(text, pos)
+        if match is None:
+            return
+        pos = match.end()
+        if match.group('name'):
+            if text.startswith('(', pos):
+                close = _scan(text, pos + 1, ')')
+                value, array = text[pos + 1:close], True
+                pos = close + 1
+            else:
+                close = _scan(text, pos, ' \t\n;')
+                value, array = text[pos:close], False
+                pos = close
+            if depth == 0:
+                yield match.group('name'), match.group('append'), array, value
+        elif match.group('open'):
+            depth += 1
+        elif match.group('close'):
+            depth = max(depth - 1, 0)
+
+def _unquote(match):
+    escaped, single, double = match.groups()
+    if double is not None:
+        return re.sub(r'\\([$`"\\])', r'\1', double)
+    return escaped if escaped is not None else single
+
+def _words(value):
+    """Split a shell value into words, dropping quotes and comments"""
+    return [_quoting.sub(_unquote, word) if '\\' in word or "'" in word or
+            '"' in word else word
+            for word in _word.findall(value) if not word.startswith('#')]
+
+def parse_pkgbuild(text):
+    """Return the variables of a PKGBUILD as a dict of lists"""
+    fields = {}
+    scalars = {}
+    expand = lambda m: scalars.get(m.group(1), m.group(0))
+    for name, append, array, value in _assignments(text):
+        words = _words(value)
+        if '$' in value:
+            words = [_variable.sub(expand, word) if '$' in word else word
+                     for word in words]
+        if not array:
+            words = [' '.join(words)]
+            scalars[name] = words[0]
+        if append:
+            fields[name] = fields.get(name, []) + words
+        else:
+            fields[name] = words
+    return fields
+
+def parse_srcinfo(text, name=None):
+    """Return the fields of a .SRCINFO as a dict of lists
+
+    Fields of the ``pkgname`` section matching name (or of the first one)
+    replace those of the ``pkgbase`` section.
+    """
+    base, sections, current = {}, [], {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition(' = ')
+        if not sep or key.startswith('#'):
+            continue
+        if key == 'pkgbase':
+            current = base
+        elif key == 'pkgname':
+            current = {}
+            sections.append(current)
+        current.setdefault(key, []).append(value)
+    fields = dict(base)
+    for section in sections:
+        if section['pkgname'][0] == name or section is sections[0]:
+            chosen = section
+    if sections:
+        fields.update(chosen)
+    return fields
+
+def parse_metadata(text, srcinfo=False, name=None, arch=None):
+    """Parse a PKGBUILD or .SRCINFO into a Metadata record
+
+    Records are memoized by the hash of the text, so parsing the same
+    package again costs a dict lookup. Arrays for the machine's
+    architecture are folded into the generic ones.
+
+    >>> def sample(name):
+    ...     return open(join(os.path.dirname(__file__), 'samples',
+    ...                      'pkgbuilds', name)).read()
+    >>> parse_metadata(sample('simple.PKGBUILD'))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Metadata(name='vim-pkgbuild', version='0.1-2', depends=('vim',),
+             makedepends=(), checkdepends=(), provides=(), conflicts=())
+
+    Arrays of other architectures are left out, as are those set inside
+    functions; an epoch prefixes the version:
+
+    >>> skype = sample('arch-specific.PKGBUILD')
+    >>> parse_metadata(skype, arch='x86_64')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Metadata(name='skype-bin', version='1:2.1.0.81-1',
+             depends=('alsa-lib', 'libxv', 'libxss', 'qt>=4.6',
+                      'lib32-alsa-lib', 'lib32-libxv', 'lib32-libxss',
+                      'lib32-qt'),
+             makedepends=(), checkdepends=(), provides=('skype',),
+             conflicts=('skype', 'skype-oss'))
+    >>> parse_metadata(skype, arch='i686')[2:4]
+    (('alsa-lib', 'libxv', 'libxss', 'qt>=4.6'), ('chrpath',))
+
+    Arrays may span lines, with comments and continuations, and values
+    have their variables expanded:
+
+    >>> parse_metadata(sample('multiline.PKGBUILD'))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Metadata(name='python-twisted-web2', version='8.1.0-3',
+             depends=('python>=2.5', 'python-twisted>=8.1',
+                      'python-zope-interface', 'setuptools'),
+             makedepends=('python-sphinx', 'graphviz'),
+             checkdepends=('python-nose',), provides=('twisted-web2=8.1.0',),
+             conflicts=('twisted-web2',))
+    >>> parse_metadata(sample('vcs.PKGBUILD')).depends
+    ('python2', 'python2-opster', 'pacman>=3.3')
+
+    The sections of a split .SRCINFO add to its pkgbase section; name
+    picks the section, the first one otherwise:
+
+    >>> gambas = sample('split.SRCINFO')
+    >>> parse_metadata(gambas, True)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Metadata(name='gambas2-runtime', version='2.21.0-1',
+             depends=('libffi', 'xdg-utils'),
+             makedepends=('intltool', 'mysql', 'postgresql', 'libffi',
+                          'gtk2', 'qt'),
+             checkdepends=(), provides=(), conflicts=())
+    >>> parse_metadata(gambas, True, 'gambas2-gb-qt')[:3]
+    ('gambas2-gb-qt', '2.21.0-1', ('gambas2-runtime', 'qt>=4.6'))
+
+    whereas the package functions of a split PKGBUILD are not read:
+
+    >>> parse_metadata(sample('split.PKGBUILD'), name='gambas2-ide')[:3]
+    ('gambas2-ide', '2.21.0-1', ())
+    """
+    arch = arch or platform.machine()
+    key = (hashlib.sha1(text).digest(), srcinfo, name, arch)
+    if key not in _metadata:
+        if srcinfo:
+            fields = parse_srcinfo(text, name)
+        else:
+            fields = parse_pkgbuild(text)
+        names = fields.get('pkgname') or [name]
+        version = '%s-%s' % (fields.get('pkgver', [''])[0],
+                             fields.get('pkgrel', [''])[0])
+        if fields.get('epoch', ['0'])[0] not in ('', '0'):
+            version = '%s:%s' % (fields['epoch'][0], version)
+        arrays = [tuple(fields.get(a, []) + fields.get('%s_%s' % (a, arch), []))
+                  for a in metadata_arrays]
+        _metadata[key] = Metadata(name if name in names else names[0],
+                                  version, *arrays)
+    return _metadata[key]
+
+def source_metadata(sources, name=None):
+    """Return the Metadata of tarball members read by read_members,
+    preferring the .SRCINFO over the PKGBUILD"""
+    if '.SRCINFO' in sources:
+        return parse_metadata(sources['.SRCINFO'], True, name)
+    return parse_metadata(sources['PKGBUILD'], False, name)
+
+
+class JSONStream(object):
+    """Incrementally decode a JSON object read from a file
+
+    Iterating yields the members of the array under ``key`` one at a time,
+    as soon as each has been read, so the array is never held in memory as a
+    whole. The object's other members are collected in ``head``. A top level
+    array is streamed the same way.
+    """
+
+    def __init__(self, fileobj, key='results', chunk_size=16 * 1024):
+        self.fileobj = fileobj
+        self.key = key
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.head = {}
+
+    def _fill(self):
+        """Read another chunk; return False at the end of the file"""
+        if self.eof:
+            return False
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Return the next non-whitespace character without consuming it"""
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos] in ' \t\r\n'):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('unexpected end of JSON data')
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise ValueError('expected %r at %r' % (chars, self.buffer[
+                self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def _value(self):
+        number = self._peek() in '-0123456789'
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number is only whole once a delimiter follows it: "4." or
+            # "4.5e" at the end of the buffer may continue in the file
+            if (not number or (end < len(self.buffer) and
+                               self.buffer[end] in ' \t\r\n,]}') or
+                    not self._fill()):
+                self.pos = end
+                return value
+
+    def _array(self):
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        for item in self._document():
+            yield item
+        # read to the end so that readers wrapping the file see all of it
+        while self._fill():
+            pass
+
+    def _document(self):
+        if self._peek() == '[':
+            self.pos += 1
+            for item in self._array():
+                yield item
+            return
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            name = self._value()
+            self._expect(':')
+            if name == self.key and self._peek() == '[':
+                self.pos += 1
+                for item in self._array():
+                    yield item
+            else:
+                self.head[name] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+class ArthurError(Exception):
+    """Base class for errors reported to the user"""
+
+
+class DependencyCycle(ArthurError):
+    """Raised when AUR packages (indirectly) depend on themselves"""
+
+    def __str__(self):
+        return 'dependency cycle: %s' % ' -> '.join(self.args[0])
+
+
+class NetworkError(ArthurError):
+    """Raised when a request fails even after retrying"""
+
+
+class HTTPError(NetworkError):
+    """Raised for error responses; ``code`` is the HTTP status"""
+
+    def __init__(self, url, code, reason):
+        NetworkError.__init__(self, '%s: %s %s' % (url, code, reason))
+        self.code = code
+
+
+class Timeout(NetworkError):
+    """Raised when a request takes longer than its timeout"""
+
+
+class RPCError(ArthurError):
+    """Raised when the rpc answers with an error"""
+
+
+class PackageNotFound(ArthurError):
+    """Raised when a package is not in the AUR; ``name`` is the package"""
+
+    def __init__(self, name):
+        ArthurError.__init__(self, '%s: package not found' % name)
+        self.name = name
+
+
+class BuildFailed(ArthurError):
+    """Raised when a package fails to build or install; ``log`` is the
+    path of its build log"""
+
+    def __init__(self, name, log):
+        ArthurError.__init__(self, '%s: build failed; see %s' % (name, log))
+        self.name = name
+        self.log = log
+
+
+class Response(object):
+    """Response read from a pooled connection
+
+    The body is decompressed on the fly when the server gzipped it. The
+    connection goes back to its pool once the body has been read to the
+    end, or is dropped when the response is closed before that.
+    """
+
+    def __init__(self, session, key, conn, raw):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.raw = raw
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = dict(raw.getheaders())
+        self.buffer = ''
+        self.gzip = None
+        if self.headers.get('content-encoding') == 'gzip':
+            self.gzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, size=-1):
+        if self.conn is None:
+            data, self.buffer = self.buffer, ''
+            return data
+        if self.gzip is None:
+            data = self.raw.read() if size < 0 else self.raw.read(size)
+        else:
+            while size < 0 or len(self.buffer) < size:
+                chunk = self.raw.read(16 * 1024)
+                if not chunk:
+                    self.buffer += self.gzip.flush()
+                    break
+                self.buffer += self.gzip.decompress(chunk)
+            if size < 0:
+                size = len(self.buffer)
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        if self.raw.isclosed() or not data:
+            self._release(True)
+        return data
+
+    def close(self):
+        """Give up on the rest of the body"""
+        if self.conn is not None:
+            reuse = self.raw.isclosed() or self.raw.length == 0
+            if reuse:
+                # httplib wants the (empty) body read before the next request
+                self.raw.read()
+            self._release(reuse)
+
+    def _release(self, reuse):
+        conn, self.conn = self.conn, None
+        self.session.release(self.key, conn, reuse and not self.raw.will_close)
+
+    def __del__(self):
+        self.close()
+
+
+class TokenBucket(object):
+    """Let events through at ``rate`` a second on average, in bursts of at
+    most ``burst``; a rate of 0 lets everything through"""
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, sleeping until there is one; return the time
+        slept"""
+        with self.lock:
+            now = time.time()
+            wait = 0
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.stamp) * self.rate)
+                self.stamp = now
+                # a token is reserved even when the caller has to wait for it
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Scheduler(object):
+    """Shape the requests a process makes
+
+    Identical requests made while one is in flight wait for it and share
+    its result instead of going out again. Requests to each host go
+    through a TokenBucket per rate, so that a command asking for its own
+    rate does not change it for the others sharing the process, and a
+    host answering 429 or 5xx is paused for every thread for its
+    Retry-After or the backoff. ``counters`` counts
+    requests issued, coalesced into another, served from the cache,
+    throttled by the rate limit and retried.
+    """
+
+    def __init__(self, rate=0, burst=4):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+        # host -> time until which it asked to be left alone
+        self.paused = {}
+        self.inflight = {}
+        self.counters = dict.fromkeys(('issued', 'coalesced', 'cached',
+                                       'throttled', 'retried'), 0)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+        tally('requests %s' % counter)
+
+    def bucket(self, host, rate=None):
+        key = (host, self.rate if rate is None else rate)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(key[1], self.burst)
+            return self.buckets[key]
+
+    def throttle(self, host, rate=None):
+        """Wait until a request to host may be issued, at most rate a
+        second; the default is the rate of the scheduler"""
+        with self.lock:
+            wait = self.paused.get(host, 0) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        if self.bucket(host, rate).take() or wait > 0:
+            self.count('throttled')
+        self.count('issued')
+
+    def backoff(self, host, seconds):
+        """Hold back requests to host after it asked to slow down"""
+        with self.lock:
+            self.paused[host] = max(self.paused.get(host, 0),
+                                    time.time() + seconds)
+        self.count('retried')
+
+    def coalesce(self, key, func):
+        """Return func(), or the result of the call for key in flight"""
+        with self.lock:
+            call = self.inflight.get(key)
+            owner = call is None
+            if owner:
+                # done, result, error
+                call = self.inflight[key] = [threading.Event(), None, None]
+            else:
+                self.counters['coalesced'] += 1
+        if not owner:
+            tally('requests coalesced')
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = func()
+        except BaseException, e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call[0].set()
+        return call[1]
+
+    def summary(self):
+        return ', '.join('%d %s' % (self.counters[counter], counter) for
+                         counter in ('issued', 'coalesced', 'cached',
+                                     'throttled', 'retried'))
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def request_scheduler():
+    """Return the Scheduler shared by everything in this process"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+class Session(object):
+    """HTTP client that keeps connections alive between requests
+
+    At most ``per_host`` connections to a host are in use at once; idle
+    ones are kept for the next request to that host. Connection failures,
+    429 and 5xx responses are retried ``retries`` times with exponential
+    backoff.
+    """
+
+    max_redirects = 5
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, per_host=4, timeout=30, retries=3, backoff=0.5,
+                 scheduler=None):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.idle = {}
+
+    def acquire(self, key, timeout):
+        """Return a connection to key and whether it was used before"""
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.Semaphore(self.per_host)
+            slot = self.slots[key]
+        slot.acquire()
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=timeout), False
+        return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+    def release(self, key, conn, reuse):
+        if reuse and conn.sock is not None:
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self.slots[key].release()
+
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def get(self, url, headers=None, compress=True, timeout=None,
+            retries=None, rate=None):
+        """Request url and return the Response once its headers are in
+
+        Redirects are followed; 304 is returned like any other success and
+        other 4xx responses raise HTTPError. ``rate`` limits the requests a
+        second to the host, in place of the rate of the scheduler.
+        """
+        for i in range(self.max_redirects + 1):
+            response = self._get(url, headers, compress,
+                                 timeout or self.timeout,
+                                 self.retries if retries is None else retries,
+                                 rate)
+            location = response.getheader('location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
+            response.close()
+            url = urlparse.urljoin(url, location)
+        raise NetworkError('%s: too many redirects' % url)
+
+    def _get(self, url, headers, compress, timeout, retries, rate):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = dict(headers or {})
+        if compress:
+            headers['Accept-Encoding'] = 'gzip'
+        attempt = 0
+        while True:
+            if self.scheduler:
+                self.scheduler.throttle(parts.hostname, rate)
+            conn, reused = self.acquire(key, timeout)
+            delay = None
+            try:
+                with span('request', url=url):
+                    conn.request('GET', path, headers=headers)
+                    response = Response(self, key, conn, conn.getresponse())
+            except (socket.error, httplib.HTTPException), e:
+                self.release(key, conn, False)
+                if reused:
+                    # the server closed the idle connection; just reconnect
+                    continue
+                error = NetworkError('%s: %s' % (url, e))
+            else:
+                if response.status < 400:
+                    return response
+                response.close()
+                error = HTTPError(url, response.status, response.reason)
+                if response.status not in self.retry_statuses:
+                    raise error
+                retry_after = response.getheader('retry-after', '')
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+            if attempt >= retries:
+                raise error
+            delay = delay if delay is not None else self.backoff * 2 ** attempt
+            if self.scheduler:
+                # the next throttle() waits, here and in every other thread
+                self.scheduler.backoff(parts.hostname, delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def http_session():
+    """Return the Session shared by everything in this process"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = Session(scheduler=request_scheduler())
+        return _session
+
+
+class Downloader(object):
+    """Fetch many files at once into a directory
+
+    Files are written to ``<name>.part`` and renamed into place once
+    complete and verified; a partial file left behind by an earlier run is
+    resumed with a Range request. The validators and sha256 of every file
+    are recorded in a hidden ``.<name>.json`` next to it, so a file the
+    server reports unchanged is checked against its sha256 and kept.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, get, directory='.', jobs=4):
+        self.get = get
+        self.directory = directory
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.elapsed = 0.0
+        self.stats = dict.fromkeys(['fetched', 'unchanged', 'resumed',
+                                    'bytes'], 0)
+
+    def fetch_all(self, urls):
+        """Fetch urls; return the path each was stored at"""
+        started = time.time()
+        try:
+            return pool_map(self.fetch, urls, self.jobs)
+        finally:
+            self.elapsed += time.time() - started
+
+    def count(self, **counts):
+        with self.lock:
+            for name, n in counts.iteritems():
+                self.stats[name] += n
+
+    def fetch(self, url):
+        name = os.path.basename(urlparse.urlsplit(url).path)
+        # one download of a file at a time, across threads and processes
+        with open(join(self.directory, '.%s.lock' % name), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with span('download', url=url):
+                return self._fetch(url)
+
+    def _fetch(self, url):
+        name = os.path.basename(urlparse.urlsplit(url).path)
+        path = join(self.directory, name)
+        part = path + '.part'
+        meta_path = join(self.directory, '.%s.json' % name)
+        try:
+            meta = json.load(open(meta_path))
+        except (IOError, ValueError):
+            meta = {}
+        validator = meta.get('etag') or meta.get('last_modified')
+
+        headers = {}
+        offset = 0
+        if os.path.exists(path) and meta.get('sha256'):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        elif os.path.exists(part) and validator:
+            offset = os.path.getsize(part)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+
+        try:
+            response = self.get(url, headers, compress=False)
+        except HTTPError, e:
+            if not offset or not 400 <= e.code < 500:
+                raise
+            # e.g. 416 for a .part that was complete but never renamed;
+            # start over rather than fail on every later run
+            os.remove(part)
+            return self._fetch(url)
+        if response.status == 304:
+            response.close()
+            if file_digest(path, 'sha256') == meta['sha256']:
+                self.count(unchanged=1)
+                return path
+            # the stored copy is damaged; fetch all of it again
+            os.remove(path)
+            return self._fetch(url)
+
+        meta = {'url': url, 'etag': response.getheader('etag'),
+                'last_modified': response.getheader('last-modified')}
+        if response.status == 206:
+            self.count(resumed=1)
+        else:
+            offset = 0
+        # record the validators first so an interrupted download can resume
+        write_json(meta_path, meta)
+        written = 0
+        with open(part, 'ab' if offset else 'wb') as f:
+            while True:
+                data = response.read(self.chunk_size)
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+        self.count(bytes=written)
+        tally('bytes downloaded', written)
+
+        length = response.getheader('content-length')
+        if length and length.isdigit() and int(length) != written:
+            raise NetworkError('%s: got %d of %s bytes' % (url, written,
+                                                           length))
+        md5 = response.getheader('content-md5')
+        if md5 and not offset and (file_digest(part, 'md5') !=
+                                   md5.decode('base64').encode('hex')):
+            os.remove(part)
+            raise NetworkError('%s: checksum mismatch' % url)
+        meta['sha256'] = file_digest(part, 'sha256')
+        meta['size'] = os.path.getsize(part)
+        os.rename(part, path)
+        write_json(meta_path, meta)
+        self.count(fetched=1)
+        return path
+
+    def summary(self):
+        kb = self.stats['bytes'] / 1024.0
+        stats = dict(self.stats, elapsed=self.elapsed, kb=kb,
+                     rate=kb / max(self.elapsed, 0.001))
+        return ('fetched %(fetched)d files (%(kb).1f kB) in %(elapsed).1fs, '
+                '%(rate).1f kB/s; %(unchanged)d unchanged, %(resumed)d '
+                'resumed' % stats)
+
+
+def file_digest(path, algorithm):
+    """Return the hex digest of a file's contents"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_json(path, data):
+    """Write data as json to path, replacing it atomically"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+def tree_size(path):
+    """Return the total size of the files below path"""
+    return sum(os.path.getsize(join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+def remove(path):
+    """Remove a file or directory tree, ignoring ones that are gone"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class Store(object):
+    """Content addressed store of package sources shared across runs
+
+    Tarballs are kept in ``objects/<sha256>`` and extracted, once, to
+    ``trees/<sha256>``. ``index.json`` maps each package name and version
+    to the hash of its tarball and records when every object was last used;
+    the least recently used objects are dropped once the store outgrows
+    its size limit, which is kept in the index too. Build trees are materialized from the extracted trees
+    with reflinks where the filesystem has them; otherwise large files are
+    hardlinked and the rest copied.
+    """
+
+    default_max_size = 1024 * 1024 * 1024
+
+    def __init__(self, path=None, max_size=None):
+        self._path = path
+        self.max_size = max_size
+        self.reflink = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = cache_dir('store')
+        return self._path
+
+    def _dir(self, name):
+        path = join(self.path, name)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        return path
+
+    def update(self, func):
+        """Call func with the index and save it, holding the store lock"""
+        with open(join(self.path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with span('store update'):
+                index = self.index()
+                result = func(index)
+                write_json(join(self.path, 'index.json'), index)
+            return result
+
+    def index(self):
+        try:
+            return json.load(open(join(self.path, 'index.json')))
+        except (IOError, ValueError):
+            return {'packages': {}, 'objects': {}}
+
+    def lookup(self, packages):
+        """Return the hash of the stored tarball, or None, of every (name,
+        version) in packages"""
+        def touch(index):
+            found = []
+            for name, version in packages:
+                sha = index['packages'].get('%s %s' % (name, version))
+                if sha in index['objects'] and not os.path.exists(
+                        join(self.path, 'objects', sha)):
+                    del index['objects'][sha]
+                if sha not in index['objects']:
+                    found.append(None)
+                    continue
+                index['objects'][sha]['used'] = time.time()
+                found.append(sha)
+            return found
+        return self.update(touch)
+
+    def add(self, tarballs):
+        """Store the tarball at path of every (name, version, path) in
+        tarballs; return their hashes"""
+        objects = []
+        for name, version, path in tarballs:
+            sha = file_digest(path, 'sha256')
+            obj = join(self._dir('objects'), sha)
+            if not os.path.exists(obj):
+                try:
+                    os.link(path, obj)
+                except OSError:
+                    shutil.copyfile(path, obj)
+            objects.append((name, version, sha, os.path.getsize(obj)))
+
+        def record(index):
+            for name, version, sha, size in objects:
+                index['packages']['%s %s' % (name, version)] = sha
+                entry = index['objects'].setdefault(sha, {'tree': 0})
+                entry.update(size=size, used=time.time())
+        self.update(record)
+        return [sha for name, version, sha, size in objects]
+
+    def open(self, sha):
+        return open(join(self.path, 'objects', sha), 'rb')
+
+    def tree(self, sha):
+        """Return the extracted tree of an object, extracting it once"""
+        tree = join(self._dir('trees'), sha)
+        if not os.path.isdir(tree):
+            tmp = tempfile.mkdtemp(dir=self._dir('trees'))
+            with self.open(sha) as tarball:
+                unpack(tarball, tmp)
+            try:
+                os.rename(tmp, tree)
+            except OSError:
+                # another process extracted it first
+                shutil.rmtree(tmp)
+
+            def record(index):
+                if sha in index['objects']:
+                    index['objects'][sha]['tree'] = tree_size(tree)
+            self.update(record)
+        return tree
+
+    # smaller files are copied rather than hardlinked into build trees: they
+    # are the PKGBUILDs, patches and scripts an editor may rewrite in place,
+    # which would change the store's copy through a shared inode
+    link_size = 1024 * 1024
+
+    def materialize(self, sha, dest):
+        """Recreate the extracted tree of an object below dest"""
+        tree = self.tree(sha)
+        entries = [join(tree, name) for name in os.listdir(tree)]
+        if entries and self.reflink is not False:
+            # copy the entries rather than tree/. so that dest keeps its
+            # own mode instead of taking the private one of the tree
+            cmd = ['cp', '-a', '--reflink=always'] + entries + [dest]
+            tally('subprocesses')
+            self.reflink = subprocess.call(cmd, stderr=open(os.devnull,
+                                                            'w')) == 0
+            if self.reflink:
+                return
+        for root, dirs, files in os.walk(tree):
+            target = join(dest, os.path.relpath(root, tree))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in files:
+                source = join(root, name)
+                link = join(target, name)
+                remove(link)
+                if os.path.getsize(source) < self.link_size:
+                    shutil.copy2(source, link)
+                    continue
+                try:
+                    os.link(source, link)
+                except OSError:
+                    shutil.copy2(source, link)
+
+    def limit(self, index):
+        return (self.max_size or index.get('max_size') or
+                self.default_max_size)
+
+    def set_limit(self, max_size):
+        """Remember max_size as the size limit of later runs"""
+        def save(index):
+            index['max_size'] = max_size
+        self.update(save)
+
+    def stats(self):
+        index = self.index()
+        objects = index['objects'].values()
+        return {'packages': len(index['packages']),
+                'objects': len(objects),
+                'size': sum(o['size'] for o in objects),
+                'trees': len([o for o in objects if o['tree']]),
+                'tree_size': sum(o['tree'] for o in objects),
+                'max_size': self.limit(index)}
+
+    def gc(self, max_size=None):
+        """Drop least recently used objects until the store fits max_size,
+        or the saved size limit; return how many were dropped"""
+        def collect(index):
+            limit = max_size or self.limit(index)
+            objects = sorted(index['objects'].iteritems(),
+                             key=lambda item: item[1]['used'])
+            total = sum(o['size'] + o['tree'] for sha, o in objects)
+            dropped = set()
+            while objects and total > limit:
+                sha, entry = objects.pop(0)
+                remove(join(self.path, 'objects', sha))
+                remove(join(self.path, 'trees', sha))
+                del index['objects'][sha]
+                total -= entry['size'] + entry['tree']
+                dropped.add(sha)
+            for key, sha in index['packages'].items():
+                if sha in dropped:
+                    del index['packages'][key]
+            return len(dropped)
+        dropped = self.update(collect)
+        # downloads that are no longer linked to an object
+        downloads = join(self.path, 'downloads')
+        for path in glob.glob(join(downloads, '*')):
+            if os.path.isfile(path) and os.stat(path).st_nlink == 1:
+                remove(path)
+                remove(join(downloads, '.%s.json' % os.path.basename(path)))
+        return dropped
+
+
+class LocalIndex(object):
+    """SQLite mirror of the AUR package list for offline searching
+
+    Packages are kept in a plain table for substring, prefix and regex
+    queries and in an FTS4 table over names and descriptions for word
+    queries. Rows are returned shaped like rpc search results.
+    """
+
+    columns = [('Name', 'name'), ('Version', 'version'),
+               ('NumVotes', 'votes'), ('Popularity', 'popularity'),
+               ('OutOfDate', 'out_of_date'), ('Description', 'description'),
+               ('URLPath', 'urlpath')]
+
+    def __init__(self, path=None):
+        self.path = path or join(cache_dir(), 'packages.db')
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            if not os.path.exists(self.path):
+                raise ArthurError("no local package index; run "
+                                  "'arthur sync-index' first")
+            self._db = self.connect(self.path)
+        return self._db
+
+    @staticmethod
+    def connect(path):
+        db = sqlite3.connect(path)
+        db.create_function('regexp', 2, _regexp)
+        return db
+
+    def build(self, packages, source, etag=None):
+        """Replace the index with packages; return how many were stored"""
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path),
+                                          prefix='tmp', delete=False).name
+        db = self.connect(tmp)
+        try:
+            db.executescript("""
+                create table packages (
+                    name text primary key, version text, votes integer,
+                    popularity real, out_of_date integer, description text,
+                    urlpath text);
+                create virtual table words using
+                    fts4(name, description, content="packages");
+                create table meta (key text primary key, value text);
+            """)
+            db.executemany(
+                'insert or replace into packages values (?, ?, ?, ?, ?, ?, ?)',
+                (self._row(package) for package in packages))
+            db.execute("insert into words(words) values ('rebuild')")
+            db.executemany('insert into meta values (?, ?)',
+                           [('source', source), ('etag', etag),
+                            ('synced', time.time())])
+            db.commit()
+            count = db.execute('select count(*) from packages').fetchone()[0]
+        except:
+            db.close()
+            os.remove(tmp)
+            raise
+        db.close()
+        os.rename(tmp, self.path)
+        self._db = None
+        return count
 
+    @staticmethod
+    def _row(package):
+        return (package['Name'], package.get('Version'),
+                int(package.get('NumVotes') or 0),
+                float(package.get('Popularity') or 0),
+                int(package.get('OutOfDate') or 0),
+                package.get('Description') or '', package.get('URLPath'))
 
-class OutputFormatter(object):
-    """Style the output of a command"""
+    def meta(self, key):
+        try:
+            row = self.db.execute('select value from meta where key = ?',
+                                  (key,)).fetchone()
+        except ArthurError:
+            return None
+        return row and row[0]
 
-    def __init__(self, str=None, color=''):
-        import textwrap
+    def names(self):
+        """Return every package name, sorted"""
+        return [row[0] for row in
+                self.db.execute('select name from packages order by name')]
 
-        self.str = str
-        self.wrapper = textwrap.TextWrapper()
+    def packages(self, names):
+        """Return the packages called names, in no particular order"""
+        keys = [key for key, column in self.columns]
+        query = 'select %s from packages where name in (%%s)' % ', '.join(
+            column for key, column in self.columns)
+        packages = []
+        # stay below SQLite's limit on parameters per statement
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            rows = self.db.execute(query % ', '.join('?' * len(chunk)), chunk)
+            packages.extend(dict(zip(keys, row)) for row in rows)
+        return packages
 
-        curses.setupterm()
-        fg = curses.tigetstr('setaf')
-        bg = curses.tigetstr('setab')
-        self.cmap = {}
-        for color in "BLUE GREEN CYAN RED MAGENTA YELLOW WHITE BLACK".split():
-            index = getattr(curses, 'COLOR_%s' % color)
-            self.cmap[color] = curses.tparm(fg, index)
-            self.cmap['BG_%s' % color] = curses.tparm(bg, index)
-        self.cmap['NORMAL'] = curses.tigetstr('sgr0')
-        self.cmap['BG_NORMAL'] = curses.tigetstr('sgr0')
-        self.cmap['BOLD'] = curses.tigetstr('bold')
-
-    def render(self):
-        self.wrapper.initial_indent = self.indent
-        self.wrapper.subsequent_indent = self.subsequent_indent
-        for line in self.wrapper.wrap(self.str):
+    def search(self, term, title=False, mode='substring'):
+        """Return an iterator over the packages matching term
+
+        ``mode`` is substring (like the rpc), prefix (of the name), regex
+        or words (an FTS query).
+        """
+        fields = ['name'] if title else ['name', 'description']
+        if mode == 'prefix':
+            # a range over the primary key instead of a scan
+            where, args = 'name >= ? and name < ?', [
+                term, term[:-1] + unichr(ord(term[-1]) + 1)]
+        elif mode == 'regex':
             try:
-                output = u'%s%s%s%s%s' % (self.cmap[self.bg.upper()],
-                                          self.style,
-                                          self.cmap[self.fg.upper()],
-                                          line,
-                                          self.cmap['NORMAL'])
-            except (KeyError, AttributeError):
-                output = line
-            output = output.encode('utf8') + self.separator
-            sys.stdout.write(output)
-
-    def __call__(self, str, **kwargs):
-        self.str = str
-        self.indent = kwargs.get('indent', '')
-        self.subsequent_indent = kwargs.get('subsequent_indent', self.indent)
-        self.fg = kwargs.get('fg')
-        self.bg = kwargs.get('bg')
-        self.bg = 'BG_%s' % self.bg if self.bg else 'BG_NORMAL'
-        self.separator = kwargs.get('separator', '\n')
-        self.style = kwargs.get('style', '')
-        try:
-            self.style = self.cmap[self.style.upper()]
-        except KeyError:
-            pass
+                re.compile(term)
+            except re.error, e:
+                raise ArthurError('bad regular expression: %s' % e)
+            where = ' or '.join('%s regexp ?' % f for f in fields)
+            args = [term] * len(fields)
+        elif mode == 'words':
+            where = 'rowid in (select docid from words where %s match ?)' % (
+                'name' if title else 'words')
+            args = [term]
+        else:
+            pattern = '%%%s%%' % re.sub(r'([\\%_])', r'\\\1', term)
+            where = ' or '.join("%s like ? escape '\\'" % f for f in fields)
+            args = [pattern] * len(fields)
+        query = 'select %s from packages where %s' % (
+            ', '.join(column for key, column in self.columns), where)
+        try:
+            rows = self.db.execute(query, args)
+        except sqlite3.OperationalError, e:
+            raise ArthurError(str(e))
+        keys = [key for key, column in self.columns]
+        return (dict(zip(keys, row)) for row in rows)
+
+
+def trigrams(name):
+    return set(name[i:i + 3] for i in range(len(name) - 2))
+
+
+def prefixed(names, term):
+    """Return the items of the sorted list names starting with term"""
+    if not term:
+        return list(names)
+    start = bisect.bisect_left(names, term)
+    end = bisect.bisect_left(names, term[:-1] + unichr(ord(term[-1]) + 1))
+    return names[start:end]
+
+
+class NameIndex(object):
+    """In memory index of package names
+
+    A sorted list answers prefix queries by bisection and an inverted
+    index from trigrams to names answers substring queries and finds
+    names similar to a misspelt one.
+    """
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self.postings = {}
+        self.sizes = []
+        for i, name in enumerate(self.names):
+            grams = trigrams(name)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                try:
+                    self.postings[gram].append(i)
+                except KeyError:
+                    self.postings[gram] = [i]
+
+    def prefix(self, term):
+        """Return the names starting with term"""
+        return prefixed(self.names, term)
+
+    def substring(self, term):
+        """Return the names containing term"""
+        if len(term) < 3:
+            return [name for name in self.names if term in name]
+        # every match is in the shortest posting list of its trigrams
+        shortest = min((self.postings.get(gram, ()) for gram in
+                        trigrams(term)), key=len)
+        return [self.names[i] for i in shortest if term in self.names[i]]
+
+    def suggest(self, term, count=5, cutoff=0.4):
+        """Return up to count names most similar to term, best first"""
+        grams = trigrams(term)
+        # a name scoring cutoff shares at least needed trigrams with term,
+        # so it is in one of the len(grams) - needed + 1 rarest postings
+        needed = max(1, int(math.ceil(cutoff * len(grams))))
+        rarest = sorted((self.postings.get(gram, ()) for gram in grams),
+                        key=len)[:len(grams) - needed + 1]
+        scores = []
+        for i in set(chain(*rarest)):
+            shared = len(grams & trigrams(self.names[i]))
+            # Jaccard similarity of the trigram sets
+            scores.append((float(shared) / (len(grams) + self.sizes[i] -
+                                            shared), i))
+        return [self.names[i] for score, i in heapq.nlargest(count, scores)
+                if score >= cutoff]
+
+
+_name_index = {}
+_name_index_lock = threading.Lock()
+
+def name_index(index=None):
+    """Return the NameIndex of the local package index, built once per
+    process and rebuilt when the index changes; None without one"""
+    index = index or LocalIndex()
+    try:
+        key = (index.path, os.path.getmtime(index.path))
+    except OSError:
+        return None
+    with _name_index_lock:
+        if _name_index.get('key') != key:
+            _name_index.update(key=key, index=NameIndex(index.names()))
+        return _name_index['index']
+
+
+_regexps = {}
+
+def _regexp(pattern, value):
+    """SQLite REGEXP function backed by cached compiled patterns"""
+    try:
+        regexp = _regexps[pattern]
+    except KeyError:
+        regexp = _regexps[pattern] = re.compile(pattern)
+    return value is not None and regexp.search(value) is not None
+
+
+class Resolver(object):
+    """Build the AUR dependency graph of a set of packages
+
+    The graph is walked breadth first. The packages of each level are looked
+    up with a single batched ``lookup`` call and then fetched with a single
+    batched ``fetch`` call; every package is looked up and fetched at most
+    once.
+    """
+
+    def __init__(self, lookup, fetch):
+        self.lookup = lookup
+        self.fetch = fetch
+        self.pacman = {}
+        self.aur = {}
 
-        self.render()
+    def add(self, name, pacman, aur):
+        """Record the dependencies of a package that was not fetched"""
+        self.pacman[name] = pacman
+        self.aur[name] = aur
 
-def pacman_query(query):
-    print query
-    proc = Popen(query, shell=True, stdout=PIPE, stderr=PIPE)
-    out, error = proc.communicate()
-    return out.strip() or False
+    def resolve(self, names):
+        """Fetch names and their dependencies; return the install plan"""
+        with span('resolve', names=' '.join(names)):
+            return self._resolve(names)
 
-def exists_locally(pkg):
-    return pacman_query('pacman -Q %s' % pkg)
+    def _resolve(self, names):
+        for missing in self.levels(names):
+            packages = self.packages(missing, self.lookup(missing))
+            for name, deps in zip(missing, self.fetch(packages)):
+                self.add(name, *deps)
+        return self.plan(names)
 
-def exists_in_repo(pkg):
-    return pacman_query('pacman -Ssq %s' % pkg)
+    def levels(self, names):
+        """Walk the graph from names breadth first, yielding the names of
+        each level that are not known yet; the caller looks them up and
+        add()s their dependencies before the walk goes on"""
+        expanded = set()
+        frontier = unique(names)
+        while frontier:
+            missing = [name for name in frontier if name not in self.aur]
+            if missing:
+                yield missing
+            expanded.update(frontier)
+            frontier = unique(dep for name in frontier
+                              for dep in self.aur[name]
+                              if dep not in expanded)
+
+    def packages(self, names, found):
+        """Return the info of names from the result of a lookup"""
+        for name in names:
+            if name not in found:
+                raise PackageNotFound(name)
+        return [found[name] for name in names]
+
+    def plan(self, names):
+        """Order names and their dependencies so dependencies come first"""
+        order = []
+        done = set()
+        path = []
+
+        def visit(name):
+            if name in done:
+                return
+            if name in path:
+                raise DependencyCycle(path[path.index(name):] + [name])
+            path.append(name)
+            for dep in self.aur[name]:
+                visit(dep)
+            path.pop()
+            done.add(name)
+            order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    def pacman_dependencies(self, plan):
+        """Return the repo dependencies of every package in plan"""
+        return unique(dep for name in plan for dep in self.pacman[name])
+
+
+class BuildScheduler(object):
+    """Build packages in dependency order, several at once
+
+    ``dependencies`` maps every package to those of its dependencies that
+    are built here too. A package is built, by calling ``build`` with its
+    name in a thread of its own, as soon as all of those have been, with
+    at most ``jobs`` builds running at once. No build starts after one has
+    failed; the ones already running are waited for.
+    """
+
+    def __init__(self, dependencies, build, jobs=4):
+        self.dependencies = dependencies
+        self.build = build
+        self.jobs = max(1, jobs)
+        self.condition = threading.Condition()
+        self.running = set()
+        self.built = []
+        self.failed = []
+
+    def run(self, names):
+        """Build names, which must be in dependency order; return the
+        names built and the (name, error) of failed builds"""
+        waiting = list(names)
+        with self.condition:
+            while True:
+                while (waiting and not self.failed and
+                       len(self.running) < self.jobs):
+                    ready = next((name for name in waiting
+                                  if all(dep in self.built for dep in
+                                         self.dependencies.get(name, ()))),
+                                 None)
+                    if ready is None:
+                        break
+                    waiting.remove(ready)
+                    self.running.add(ready)
+                    thread = threading.Thread(target=self.worker,
+                                              args=(ready,))
+                    thread.daemon = True
+                    thread.start()
+                if not self.running:
+                    return self.built, self.failed
+                # wait with a timeout so ^C is seen
+                self.condition.wait(1)
+
+    def worker(self, name):
+        try:
+            self.build(name)
+        except Exception, e:
+            with self.condition:
+                self.failed.append((name, e))
+        else:
+            with self.condition:
+                self.built.append(name)
+        finally:
+            with self.condition:
+                self.running.discard(name)
+                self.condition.notify()
 
 
 class Arthur(object):
@@ -90,14 +2427,52 @@ class Arthur(object):
     search_url = 'http://aur.archlinux.org/rpc.php?type=search&arg='
     rpc_url = 'http://aur.archlinux.org/rpc.php'
     aur_url = 'http://aur.archlinux.org'
+    sync_root = '/var/lib/pacman/sync'
+    # keep multiinfo urls well below common server request line limits
+    max_url_length = 4000
 
-    def __init__(self, term=None, formatter=OutputFormatter(), **opts):
+    def __init__(self, term=None, formatter=None, **opts):
         self.term = ' '.join(term) if term else term
+        if opts.get('aur_url'):
+            self.aur_url = opts['aur_url'].rstrip('/')
+            self.rpc_url = self.aur_url + '/rpc.php'
         self.segments = list(urlparse.urlsplit(self.rpc_url))
         self.debug = opts.get('debug', False)
-        self.formatter = formatter
+        self.formatter = formatter or OutputFormatter()
         self.path = opts.get('path')
         self.search_title = opts.get('title')
+        self.format = opts.get('format') or 'text'
+        self.fields = [f for f in (opts.get('fields') or '').split(',') if f]
+        self.sort = opts.get('sort', 'Name')
+        # how to query the local package index, if at all
+        self.local = next((mode for mode in ('regex', 'prefix', 'words')
+                           if opts.get(mode)), None)
+        if opts.get('local') and not self.local:
+            self.local = 'substring'
+        self.jobs = int(opts.get('jobs') or 4)
+        self.offline = opts.get('offline', False)
+        self.refresh = opts.get('refresh', False)
+        self.cache = ResponseCache()
+        self.session = http_session()
+        self.timeout = opts.get('timeout') or None
+        self.retries = opts.get('retries')
+        self.verbose = opts.get('verbose', False)
+        self.scheduler = request_scheduler()
+        # requests a second to each host; None leaves it to the scheduler
+        self.rate = float(opts['rate']) if opts.get('rate') else None
+        self.builddir = opts.get('builddir') or '.'
+        self.build = not opts.get('no_build')
+        self.store = Store()
+        # name -> hash of the stored tarball of every fetched package
+        self.objects = {}
+        self._downloader = None
+
+    @property
+    def downloader(self):
+        if self._downloader is None:
+            self._downloader = Downloader(
+                self.get, self.store._dir('downloads'), self.jobs)
+        return self._downloader
 
     def aur(self, path):
         segments = list(urlparse.urlsplit(self.aur_url))
@@ -105,84 +2480,534 @@ class Arthur(object):
         return urlparse.urlunsplit(segments)
 
     def url(self, type, arg=None):
-        data = {'type': type}
-        if arg is not None:
-            data['arg'] = arg
-        self.segments[3] = urllib.urlencode(data)
-        return urlparse.urlunsplit(self.segments)
+        """Build an rpc url; a list arg is sent as multiple ``arg[]``"""
+        data = [('type', type)]
+        if isinstance(arg, (list, tuple)):
+            data.extend(('arg[]', a) for a in arg)
+        elif arg is not None:
+            data.append(('arg', arg))
+        # build from a copy; urls are built from several threads at once
+        segments = list(self.segments)
+        segments[3] = urllib.urlencode(data)
+        return urlparse.urlunsplit(segments)
 
     def decode(self, url):
         if self.debug:
             return json.load(open('cache.json'))
+        with span('decode', url=url):
+            return self.scheduler.coalesce(
+                url, lambda: json.load(self.open_rpc(url)))
+
+    def open_rpc(self, url):
+        """Return the body of an rpc response, from the cache if possible"""
+        entry = self.cache.get(url)
+        if entry and (self.offline or
+                      (not self.refresh and self.cache.fresh(entry))):
+            self.scheduler.count('cached')
+            return self.cache.open(entry)
+        if self.offline:
+            sys.exit('%s: not in the cache' % url)
+
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
         try:
-            return json.loads(urllib2.urlopen(url).read())
-        except urllib2.URLError, e:
-            sys.exit(e.args)
+            response = self.get(url, headers)
+        except NetworkError, e:
+            sys.exit(str(e))
+        if response.status == 304 and entry:
+            response.close()
+            self.cache.revalidated(entry, response.headers)
+            return self.cache.open(entry)
+        return self.cache.reader(url, response, response.headers)
+
+    def get(self, url, headers=None, compress=True):
+        return self.session.get(url, headers, compress, self.timeout,
+                                self.retries, self.rate)
+
+    def stream(self, url):
+        """Yield the results of an rpc response as they are read"""
+        fileobj = open('cache.json') if self.debug else self.open_rpc(url)
+        response = JSONStream(fileobj)
+        for package in response:
+            yield package
+        if response.head.get('type') == 'error':
+            raise ArthurError(response.head.get('results'))
+
+    def multiinfo(self, names):
+        """Look up the info of many packages in as few requests as possible
+
+        Returns a dict mapping package name to info; names that are not in
+        the AUR are missing from it.
+        """
+        found = {}
+        chunks = list(self.chunks(names))
+        # the chunks go out at once, so any number of names takes about
+        # one round trip
+        responses = pool_map(self.decode, [self.url('multiinfo', chunk)
+                                           for chunk in chunks], self.jobs)
+        for chunk, response in zip(chunks, responses):
+            if response['type'] == 'error':
+                raise RPCError('%s: %s' % (' '.join(chunk),
+                                           response['results']))
+            for package in response['results']:
+                found[package['Name']] = package
+        return found
+
+    def chunks(self, names):
+        """Split names into lists that each fit in one multiinfo url"""
+        base = len(self.url('multiinfo', []))
+        chunk, length = [], base
+        for name in names:
+            extra = len(urllib.urlencode([('arg[]', name)])) + 1
+            if chunk and length + extra > self.max_url_length:
+                yield chunk
+                chunk, length = [], base
+            chunk.append(name)
+            length += extra
+        if chunk:
+            yield chunk
 
     def search(self):
         if not self.term:
             sys.exit(1)
-        url = self.url('search', self.term)
-        response = self.decode(url)
-        if response['type'] == 'error':
-            sys.exit('%s: %s' % (self.term, response['results']))
-        packages = sorted(response['results'], key=lambda x: x['Name'])
-        if self.search_title:
-            packages = [p for p in packages if self.term in p['Name']]
-        for package in packages:
-            pkg_detail = "aur/%(Name)s %(Version)s (%(NumVotes)s)" % package
-            self.formatter('aur/', fg='magenta', separator='', style='bold')
-            self.formatter('%(Name)s ' % package, separator=' ', fg='white',
-                           style='bold')
-            color = 'red' if int(package['OutOfDate']) else 'green'
-            self.formatter('%(Version)s ' % package, separator=' ', fg=color,
-                          style='bold')
-            self.formatter('(%(NumVotes)s)' % package, fg='black', bg='yellow')
-            self.formatter("%(Description)s" % package, indent="\t")
+        try:
+            write = getattr(self, 'write_%s' % self.format)
+        except AttributeError:
+            sys.exit('unknown format: %s' % self.format)
+        if self.local:
+            term = self.term.decode('utf8')
+            index = LocalIndex()
+            try:
+                if self.local == 'substring' and self.search_title:
+                    names = name_index(index)
+                    if names is None:
+                        index.db  # raises the missing index error
+                    packages = index.packages(names.substring(term))
+                else:
+                    packages = index.search(term, self.search_title,
+                                            self.local)
+            except ArthurError, e:
+                sys.exit('%s: %s' % (self.term, e))
+        else:
+            packages = self.stream(self.url('search', self.term))
+            if self.search_title:
+                packages = (p for p in packages if self.term in p['Name'])
+        if self.sort:
+            packages = sorted(packages, key=self.sort_key)
+        if self.format == 'tsv':
+            self.formatter.write('\t'.join(self.fields or self.tsv_fields) +
+                                 '\n')
+        found = False
+        try:
+            for package in packages:
+                found = True
+                write(package)
+                if not self.sort and self.format != 'text':
+                    # unsorted machine output is streamed record by record
+                    self.formatter.flush()
+        except ArthurError, e:
+            self.formatter.flush()
+            sys.exit('%s: %s' % (self.term, e))
+        self.formatter.flush()
+        self.report()
+        if not found and self.format == 'text':
+            self.did_you_mean()
+
+    def report(self):
+        """Say how the requests of this process went, with --verbose"""
+        if self.verbose:
+            sys.stderr.write('==> requests: %s\n' % self.scheduler.summary())
+
+    def did_you_mean(self):
+        """Suggest similar names from the local package index, if any"""
+        names = name_index()
+        suggestions = names and names.suggest(self.term.decode('utf8'))
+        if suggestions:
+            sys.stderr.write('%s: no packages found; did you mean %s?\n' % (
+                self.term, ', '.join(suggestions)))
+
+    # dump of every AUR package, regenerated by the AUR every few minutes
+    packages_path = '/packages-meta-v1.json.gz'
+
+    def update_index(self, dump=None):
+        """Rebuild the local package index from dump, a file, or the AUR"""
+        index = LocalIndex()
+        if dump:
+            fileobj, source = open(dump, 'rb'), os.path.abspath(dump)
+        else:
+            source = self.aur(self.packages_path)
+            headers = {}
+            if index.meta('source') == source and index.meta('etag'):
+                headers['If-None-Match'] = index.meta('etag')
+            try:
+                fileobj = self.get(source, headers)
+            except ArthurError, e:
+                sys.exit(str(e))
+            if fileobj.status == 304:
+                fileobj.close()
+                self.formatter('local package index is up to date')
+                self.formatter.flush()
+                return
+        start = time.time()
+        try:
+            with closing(fileobj):
+                etag = getattr(fileobj, 'getheader', lambda name: None)('etag')
+                count = index.build(JSONStream(open_dump(fileobj)), source,
+                                    etag)
+        except (ArthurError, ValueError, KeyError, IOError), e:
+            sys.exit('%s: %s' % (source, e))
+        self.formatter('indexed %d packages in %.1fs' % (
+            count, time.time() - start))
+        self.formatter.flush()
+
+    def sort_key(self, package):
+        value = package.get(self.sort)
+        try:
+            return (0, float(value), '')
+        except (TypeError, ValueError):
+            return (1, 0, value)
+
+    def write_text(self, package):
+        self.formatter('aur/', fg='magenta', separator='', style='bold')
+        self.formatter('%(Name)s ' % package, separator=' ', fg='white',
+                       style='bold')
+        color = 'red' if int(package['OutOfDate']) else 'green'
+        self.formatter('%(Version)s ' % package, separator=' ', fg=color,
+                      style='bold')
+        self.formatter('(%(NumVotes)s)' % package, fg='black', bg='yellow')
+        self.formatter("%(Description)s" % package, indent="\t")
+
+    def write_json(self, package):
+        if self.fields:
+            package = dict((f, package.get(f)) for f in self.fields)
+        self.formatter.write(json.dumps(package) + '\n')
+
+    # columns written by --format tsv unless --fields says otherwise
+    tsv_fields = ['Name', 'Version', 'NumVotes', 'OutOfDate', 'Description']
+
+    def write_tsv(self, package):
+        values = []
+        for field in self.fields or self.tsv_fields:
+            value = package.get(field)
+            value = u'' if value is None else unicode(value)
+            value = value.replace('\\', '\\\\').replace('\t', '\\t')
+            values.append(value.replace('\n', '\\n').encode('utf8'))
+        self.formatter.write('\t'.join(values) + '\n')
+
+    # fields written by info in text format, when the package has them
+    info_fields = ['Name', 'Version', 'Description', 'URL', 'License',
+                   'Maintainer', 'NumVotes', 'Popularity', 'OutOfDate',
+                   'Depends', 'MakeDepends', 'CheckDepends', 'OptDepends',
+                   'Provides', 'Conflicts']
+
+    def write_info(self, package):
+        for field in self.info_fields:
+            value = package.get(field)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                value = '  '.join(value) or 'None'
+            self.formatter(u'%-14s: %s' % (field, value),
+                           subsequent_indent=' ' * 16)
+        self.formatter.write('\n')
+
+    def info(self, names):
+        """Print the AUR info of names, in the order given"""
+        if self.format == 'text':
+            write = self.write_info
+        else:
+            try:
+                write = getattr(self, 'write_%s' % self.format)
+            except AttributeError:
+                sys.exit('unknown format: %s' % self.format)
+        try:
+            found = self.multiinfo(names)
+        except ArthurError, e:
+            sys.exit(str(e))
+        if self.format == 'tsv':
+            self.formatter.write('\t'.join(self.fields or self.tsv_fields) +
+                                 '\n')
+        for name in unique(names):
+            if name in found:
+                write(found[name])
+        self.formatter.flush()
+        self.report()
+        missing = [name for name in names if name not in found]
+        if missing:
+            sys.exit('not in the AUR: %s' % ' '.join(missing))
+
+    def outdated(self):
+        """Print the foreign packages with a newer version in the AUR"""
+        if self.format not in ('text', 'json'):
+            sys.exit('unknown format: %s' % self.format)
+        try:
+            foreign = pacman_query('-Qm')
+        except ArthurError, e:
+            sys.exit(str(e))
+        installed = dict(line.split()[:2] for line in foreign.splitlines()
+                         if len(line.split()) >= 2)
+        try:
+            found = self.multiinfo(sorted(installed))
+        except ArthurError, e:
+            sys.exit(str(e))
+        for name in sorted(installed):
+            if name not in found:
+                if self.verbose:
+                    sys.stderr.write('%s: not in the AUR\n' % name)
+                continue
+            version = found[name]['Version']
+            if vercmp(version, installed[name]) <= 0:
+                continue
+            if self.format == 'json':
+                self.formatter.write(json.dumps({
+                    'Name': name, 'Installed': installed[name],
+                    'Version': version}) + '\n')
+            else:
+                self.formatter(name, separator=' ', style='bold')
+                self.formatter('%s ->' % installed[name], separator=' ',
+                               fg='red')
+                self.formatter(version, fg='green')
+        self.formatter.flush()
+        self.report()
 
     def install(self):
+        resolver = Resolver(self.multiinfo, self.fetch)
         if os.path.exists(self.term):
             # process this local file
             pkgbuild = self.extract_PKGBUILD(self.term)
-            pacman, aur = self.find_dependencies(pkgbuild)
-            for dep in aur:
-                Arthur(term=[dep]).download()
-        else:
-            pacman, aur = self.download(self.term)
+            resolver.add(self.term, *self.find_dependencies(pkgbuild))
+        try:
+            plan = resolver.resolve([self.term])
+        except ArthurError, e:
+            sys.exit(str(e))
+        pacman = resolver.pacman_dependencies(plan)
+        self.formatter('==>', fg='yellow', separator=' ')
+        self.formatter(self.downloader.summary())
+        self.store.gc()
+        try:
+            state = PacmanState().load()
+        except ArthurError, e:
+            sys.exit(str(e))
 
         self.formatter('==>', fg='yellow', separator=' ')
         self.formatter('%s dependencies' % self.term)
+        missing = []
+        unavailable = False
         for dep in pacman:
-            if exists_locally(dep):
+            if state.is_installed(dep):
                 status = '(already installed)'
                 colour = 'normal'
-            elif exists_in_repo(dep):
+            elif state.in_repo(dep) or self.in_sync(dep):
                 status = '(package found)'
                 colour = 'blue'
+                missing.append(dep)
+            else:
+                status = '(not found)'
+                colour = 'red'
+                unavailable = True
             self.formatter('%s %s' % (dep, status), fg=colour, indent=' - ')
-        sys.exit(1)
+        self.formatter.flush()
+        self.report()
+        if not self.build or unavailable:
+            sys.exit(1)
+        if self.term not in self.objects and not os.path.isdir(self.term):
+            sys.exit('%s: cannot build from a tarball; extract it and pass'
+                     ' its directory' % self.term)
+        # only now that there is something to build, extract the sources
+        directories = {}
+        # packages split from one pkgbase share their tarball and its tree
+        trees = {}
+        for name in plan:
+            if name in self.objects:
+                sha = self.objects[name]
+                if sha not in trees:
+                    trees[sha] = self.build_tree(sha, name)
+                directories[name] = trees[sha]
+            elif os.path.isdir(name):
+                directories[name] = name
+        self.build_plan(plan, dict((name, resolver.aur[name])
+                                   for name in plan), directories, missing)
+
+    def build_tree(self, sha, name):
+        """Materialize a stored tarball below the build directory; return
+        the directory holding its PKGBUILD"""
+        tree = self.store.tree(sha)
+        if os.path.isfile(join(tree, 'PKGBUILD')):
+            # a flat tarball; give it a directory of its own
+            directory = join(self.builddir, name)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.store.materialize(sha, directory)
+            return directory
+        self.store.materialize(sha, self.builddir)
+        # the tarball holds a directory named after the pkgbase
+        top = [entry for entry in sorted(os.listdir(tree))
+               if os.path.isfile(join(tree, entry, 'PKGBUILD'))]
+        if not top:
+            raise ArthurError('%s: no PKGBUILD in its tarball' % name)
+        return join(self.builddir, top[0])
+
+    def build_plan(self, plan, dependencies, directories, repo):
+        """Install the repo packages the plan needs, then build and install
+        its AUR packages in dependency order, ``jobs`` at a time
+
+        Packages split from one pkgbase are built together, once.
+        """
+        if repo:
+            self.formatter('==>', fg='yellow', separator=' ')
+            self.formatter('installing %s' % ' '.join(repo))
+            self.formatter.flush()
+            tally('subprocesses')
+            with span('pacman -S'):
+                failed = subprocess.call(self.pacman + [
+                    '-S', '--needed', '--asdeps', '--noconfirm'] + repo)
+            if failed:
+                sys.exit('pacman failed to install %s' % ' '.join(repo))
+        # build directory -> the packages of the plan it makes
+        self.groups = {}
+        for name in plan:
+            self.groups.setdefault(directories[name], []).append(name)
+        builds = unique(directories[name] for name in plan)
+        needs = dict((directory, unique(
+            directories[dep] for name in self.groups[directory]
+            for dep in dependencies[name] if directories[dep] != directory))
+            for directory in builds)
+        self.pacman_lock = threading.Lock()
+        self.output_lock = threading.Lock()
+        start = time.time()
+        built, failed = BuildScheduler(needs, self.build_package,
+                                       self.jobs).run(builds)
+        self.formatter('==>', fg='yellow', separator=' ')
+        self.formatter('built %d of %d packages in %.1fs' % (
+            sum(len(self.groups[directory]) for directory in built),
+            len(plan), time.time() - start))
+        self.formatter.flush()
+        if failed:
+            sys.exit('\n'.join(str(error) for name, error in failed))
+
+    @property
+    def pacman(self):
+        return ['pacman'] if os.getuid() == 0 else ['sudo', 'pacman']
+
+    def build_package(self, directory):
+        """Build directory with makepkg and install the packages of the
+        plan it made"""
+        names = self.groups[directory]
+        name = ' '.join(names)
+        log = os.path.abspath(join(self.builddir, '%s.log' % os.path.basename(
+            os.path.abspath(directory))))
+        self.status('building %s' % name, log)
+        with open(log, 'w') as out:
+            tally('subprocesses')
+            with span('makepkg', package=name):
+                failed = subprocess.call(['makepkg', '--noconfirm'],
+                                         cwd=directory, stdout=out,
+                                         stderr=subprocess.STDOUT)
+            if failed:
+                self.status('%s failed' % name, None, 'red')
+                raise BuildFailed(name, log)
+            tally('subprocesses')
+            packages = subprocess.Popen(['makepkg', '--packagelist'],
+                                        cwd=directory, stdout=subprocess.PIPE,
+                                        stderr=out).communicate()[0].split()
+            if self.term in names and self.term not in self.objects:
+                # a local directory: install everything it makes
+                explicit, asdeps = packages, []
+            else:
+                packages = [path for path in packages
+                            if package_file_name(path) in names]
+                explicit = [path for path in packages
+                            if package_file_name(path) == self.term]
+                asdeps = [path for path in packages if path not in explicit]
+            # pacman locks its database; install one build at a time
+            with self.pacman_lock, span('pacman -U', package=name):
+                out.flush()
+                installed = bool(packages)
+                for flags, paths in ((['--asdeps'], asdeps), ([], explicit)):
+                    if paths and installed:
+                        tally('subprocesses')
+                        installed = not subprocess.call(
+                            self.pacman + ['-U', '--noconfirm'] + flags +
+                            paths, stdout=out, stderr=subprocess.STDOUT)
+                if not installed:
+                    self.status('%s failed to install' % name, None, 'red')
+                    raise BuildFailed(name, log)
+        self.status('built %s' % name)
+
+    def status(self, message, log=None, colour='green'):
+        with self.output_lock:
+            self.formatter('==>', fg=colour, separator=' ')
+            self.formatter(message if log is None else '%s (log: %s)' % (
+                message, log))
+            self.formatter.flush()
 
     def download(self, pkg=None):
+        """Fetch pkg and all of its AUR dependencies
+
+        Returns the repo and AUR dependencies of pkg itself.
+        """
         pkg = pkg if pkg is not None else self.term
-        url = self.url('info', pkg)
-        response = self.decode(url)
-        if response['type'] == 'error':
-            sys.exit('%s: %s' % (pkg, response['results']))
-        pkg = response['results']
-        download_url = self.aur(pkg['URLPath'])
-        pkgpath = urlparse.urlparse(download_url).path
-        file_name = os.path.basename(pkgpath)
-
-        response = urllib2.urlopen(download_url)
-        download = open(file_name, 'wb')
-        shutil.copyfileobj(response.fp, download)
-        download.close()
-        pkgbuild = self.extract_PKGBUILD(file_name)
-        pacman, aur = self.find_dependencies(pkgbuild)
-        for dep in aur:
-            Arthur(term=[dep]).download()
-        return pacman, aur
+        resolver = Resolver(self.multiinfo, self.fetch)
+        try:
+            resolver.resolve([pkg])
+        except ArthurError, e:
+            sys.exit(str(e))
+        return resolver.pacman[pkg], resolver.aur[pkg]
+
+    def deps(self, names):
+        """Print the build order of names and their repo dependencies"""
+        resolver = Resolver(self.multiinfo, self.fetch)
+        try:
+            plan = resolver.resolve(list(names))
+        except ArthurError, e:
+            sys.exit(str(e))
+        pacman = resolver.pacman_dependencies(plan)
+        if self.format == 'json':
+            self.formatter.write(json.dumps({'build': plan,
+                                             'repo': pacman}) + '\n')
+        else:
+            self.formatter('==>', fg='yellow', separator=' ')
+            self.formatter('build order')
+            for name in plan:
+                self.formatter(name, indent=' - ')
+            self.formatter('==>', fg='yellow', separator=' ')
+            self.formatter('repo dependencies')
+            for dep in pacman:
+                self.formatter(dep, indent=' - ')
+        self.formatter.flush()
+        self.report()
 
+    def fetch(self, packages):
+        """Fetch the tarballs of packages given their info into the store;
+        return the dependencies of each"""
+        stored = dict(zip([pkg['Name'] for pkg in packages],
+                          self.store.lookup([(pkg['Name'], pkg['Version'])
+                                             for pkg in packages])))
+        missing = [pkg for pkg in packages if not stored[pkg['Name']]]
+        # the packages split from one pkgbase share their tarball
+        urls = [self.aur(pkg['URLPath']) for pkg in missing]
+        paths = dict(zip(unique(urls),
+                         self.downloader.fetch_all(unique(urls))))
+        shas = self.store.add([(pkg['Name'], pkg['Version'], paths[url])
+                               for pkg, url in zip(missing, urls)])
+        stored.update(zip([pkg['Name'] for pkg in missing], shas))
+        dependencies = []
+        for pkg in packages:
+            # read the PKGBUILD from the tarball instead of extracting it
+            self.objects[pkg['Name']] = stored[pkg['Name']]
+            with span('read sources', package=pkg['Name']):
+                with self.store.open(stored[pkg['Name']]) as tarball:
+                    sources = read_members(tarball)
+            if 'PKGBUILD' not in sources:
+                raise ArthurError('%s: no PKGBUILD in %s' % (pkg['Name'],
+                                                            pkg['URLPath']))
+            with span('parse metadata', package=pkg['Name']):
+                metadata = source_metadata(sources, pkg['Name'])
+            dependencies.append(self.classify(metadata))
+        return dependencies
 
     def temp_PKGBUILD(self, pkgbuild):
         # dump the pkgbuild to a temp file
@@ -193,47 +3018,762 @@ class Arthur(object):
 
     def edit_PKGBUILD(self, fp):
         editor = os.getenv('EDITOR', 'vim')
+        tally('subprocesses')
         subprocess.call('%s %s' % (editor, fp.name), shell=True)
         return fp
 
     def extract_PKGBUILD(self, file_name):
-        try:
-            file = tarfile.open(file_name)
-        except IOError, e:
-            if e.args[0] != 21:
-                raise e
-        else:
-            file.extractall()
-        return open(join(file_name.replace('.tar.gz', ''),
-                    'PKGBUILD')).read()
+        """Return the PKGBUILD of a source tarball or directory"""
+        if os.path.isdir(file_name):
+            return open(join(file_name, 'PKGBUILD')).read()
+        with span('extract_PKGBUILD', file=file_name):
+            with open(file_name, 'rb') as tarball:
+                sources = read_members(tarball)
+        if 'PKGBUILD' not in sources:
+            sys.exit('%s: no PKGBUILD found' % file_name)
+        return sources['PKGBUILD']
 
     def find_dependencies(self, pkgbuild):
+        return self.classify(parse_metadata(pkgbuild))
+
+    def classify(self, metadata):
+        """Split the build dependencies of a package into repo and AUR
+        packages"""
         pacman = []
         aur = []
-        # for dep in self.find_dependencies(pkgbuild):
-        #     if self.in_sync(dep):
-        #         pacman.append(dep)
-        #     else:
-        #         aur.append(dep)
-        # print pacman, aur
-
-        depends = re.findall('[^opt](?:make)?depends=\((.*?)\)', pkgbuild, re.S)
-        depends = chain(*[de.split() for de in depends])
-        depends = (de.strip("'") for de in depends if de != '\\')
-        for dep in depends:
-            match = re.match('(.[^=><]*)', dep).group()
-            if self.in_sync(match):
-                pacman.append(match)
+        depends = chain(metadata.depends, metadata.makedepends,
+                        metadata.checkdepends)
+        for dep in unique(dependency_name(dep) for dep in depends):
+            if self.in_sync(dep):
+                pacman.append(dep)
             else:
-                aur.append(match)
+                aur.append(dep)
         return pacman, aur
 
     def in_sync(self, pkg):
-        for repo in ['core', 'community', 'extra']:
-            path = join('/var/lib/pacman/sync', repo)
-            if glob.glob(join(path, pkg+'-*')):
-                return repo
+        """Return the repo that provides pkg, or False"""
+        with span('in_sync'):
+            found = sync_index(self.sync_root).lookup(pkg)
+        return found[0] if found else False
+
+class Future(object):
+    """Result of an AsyncClient operation that is only known later"""
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Return the result, raising the error if the operation failed"""
+        if not self._done:
+            raise ArthurError('the operation has not finished')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        return self._error
+
+    def add_done_callback(self, callback):
+        """Call callback with this future once it is done"""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        self._done = True
+        self._result, self._error = result, error
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def gather(futures):
+    """Return a Future of the results of futures, failing with the first
+    error"""
+    gathered = Future()
+    results = [None] * len(futures)
+    pending = [len(futures)]
+
+    def done(i, future):
+        if gathered.done():
+            return
+        if future.exception() is not None:
+            gathered.set_exception(future.exception())
+            return
+        results[i] = future.result()
+        pending[0] -= 1
+        if not pending[0]:
+            gathered.set_result(results)
+
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda future, i=i: done(i, future))
+    if not futures:
+        gathered.set_result(results)
+    return gathered
+
+
+class Return(Exception):
+    """Raised by a coroutine to finish with ``value``"""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+def coroutine(func):
+    """Make a generator function that yields Futures, or lists of them,
+    return a Future of what it raises Return with"""
+    def start(*args, **kwargs):
+        future = Future()
+        generator = func(*args, **kwargs)
+
+        def step(value=None, error=None):
+            try:
+                if error is not None:
+                    yielded = generator.throw(error)
+                else:
+                    yielded = generator.send(value)
+            except Return, e:
+                future.set_result(e.value)
+                return
+            except StopIteration:
+                future.set_result(None)
+                return
+            except Exception, e:
+                future.set_exception(e)
+                return
+            if isinstance(yielded, list):
+                yielded = gather(yielded)
+            yielded.add_done_callback(
+                lambda done: step(done._result, done._error))
+
+        step()
+        return future
+    start.__name__ = func.__name__
+    start.__doc__ = func.__doc__
+    return start
+
+
+def dechunk(body):
+    """Decode a body sent with chunked transfer encoding"""
+    chunks = []
+    pos = 0
+    while True:
+        end = body.index('\r\n', pos)
+        size = int(body[pos:end].split(';')[0], 16)
+        if not size:
+            return ''.join(chunks)
+        chunks.append(body[end + 2:end + 2 + size])
+        pos = end + 4 + size
+
+
+class AsyncRequest(object):
+    """One HTTP GET made by an AsyncClient on a non-blocking socket
+
+    The request goes over its own connection, asking the server to close
+    it after the response, which is complete at end of file or once as
+    much as its headers announce has arrived.
+    """
+
+    def __init__(self, url, headers, deadline):
+        self.url = url
+        self.future = Future()
+        self.deadline = deadline
+        parts = urlparse.urlsplit(url)
+        self.tls = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.tls else 80)
+        self.key = (parts.scheme, self.host, self.port)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc,
+                 'Connection: close', 'Accept-Encoding: gzip']
+        lines += ['%s: %s' % item for item in (headers or {}).items()]
+        self.out = '\r\n'.join(lines) + '\r\n\r\n'
+        self.data = []
+        self.received = 0
+        self.length = None
+        self.state = 'connect'
+        self.sock = None
+
+    def start(self, address):
+        """Connect to address, a getaddrinfo result for the host"""
+        family, type, proto, name, address = address
+        self.sock = socket.socket(family, type, proto)
+        self.sock.setblocking(0)
+        error = self.sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readable(self):
+        return self.state == 'receive' or self.state == 'handshake read'
+
+    def writable(self):
+        return self.state in ('connect', 'send', 'handshake write')
+
+    def on_writable(self):
+        """Carry on once the socket is writable; return the response when
+        it is complete"""
+        if self.state == 'connect':
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            if self.tls:
+                context = ssl.create_default_context()
+                self.sock = context.wrap_socket(
+                    self.sock, server_hostname=self.host,
+                    do_handshake_on_connect=False)
+                return self.handshake()
+            self.state = 'send'
+        if self.state.startswith('handshake'):
+            return self.handshake()
+        try:
+            sent = self.sock.send(self.out)
+        except ssl.SSLWantWriteError:
+            return
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.out = self.out[sent:]
+        if not self.out:
+            self.state = 'receive'
+
+    def on_readable(self):
+        """Carry on once the socket is readable; return the response when
+        it is complete"""
+        if self.state.startswith('handshake'):
+            return self.handshake()
+        # TLS may hold decrypted data select cannot see, so drain it
+        while True:
+            try:
+                data = self.sock.recv(64 * 1024)
+            except ssl.SSLWantReadError:
+                return
+            except ssl.SSLEOFError:
+                data = ''  # closed without a TLS close_notify
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return self.response()
+            self.data.append(data)
+            self.received += len(data)
+            if self.complete():
+                return self.response()
+            if not self.tls:
+                return
+
+    def complete(self):
+        """Return whether the whole response has arrived, when its headers
+        say how long it is"""
+        if self.length is None:
+            data = ''.join(self.data)
+            end = data.find('\r\n\r\n')
+            if end < 0:
+                return False
+            self.data = [data]
+            head = data[:end].lower()
+            match = re.search(r'^content-length:\s*(\d+)', head, re.M)
+            if match and ' 204 ' not in head.split('\r\n')[0] and \
+                    ' 304 ' not in head.split('\r\n')[0]:
+                self.length = end + 4 + int(match.group(1))
+            elif re.search(r'^transfer-encoding:\s*chunked', head, re.M):
+                self.length = 'chunked'
+            elif re.match(r'http/1\.\d (1\d\d|204|304) ', head):
+                self.length = end + 4
+            else:
+                self.length = False  # read to end of file
+        if self.length == 'chunked':
+            return self.data[-1].endswith('0\r\n\r\n')
+        return self.length is not False and self.received >= self.length
+
+    def handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.state = 'handshake read'
+        except ssl.SSLWantWriteError:
+            self.state = 'handshake write'
+        else:
+            self.state = 'send'
+
+    def response(self):
+        """Return (status, reason, headers, body) of the received response"""
+        data = ''.join(self.data)
+        head, sep, body = data.partition('\r\n\r\n')
+        if not sep:
+            raise NetworkError('%s: connection closed early' % self.url)
+        lines = head.split('\r\n')
+        try:
+            version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise NetworkError('%s: bad status line %r' % (self.url, lines[0]))
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            body = dechunk(body)
+        if headers.get('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return status, reason, headers, body
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+class AsyncClient(object):
+    """Non-blocking AUR client for programs running an event loop
+
+    Every method returns a Future right away. The requests behind them are
+    multiplexed over non-blocking sockets by poll(), which an embedding
+    program calls from its own loop (or run() to drive the loop until a
+    future is done). At most ``per_host`` requests to a host are in
+    flight at once, every request fails with Timeout after ``timeout``
+    seconds and 429 and 5xx responses are retried with backoff. Failures
+    are raised as ArthurError subclasses: NetworkError, HTTPError,
+    Timeout, RPCError, PackageNotFound and DependencyCycle.
+
+    The constructor blocks while it loads the pacman sync databases, which
+    classifying dependencies needs, so that no later call blocks the loop:
+    host names are looked up once each and tarballs read in worker
+    threads, whose results poll() hands over on the loop's thread.
+    """
+
+    max_redirects = 5
+    retry_statuses = Session.retry_statuses
+
+    def __init__(self, aur_url=None, per_host=4, timeout=30, retries=3,
+                 backoff=0.5):
+        self.arthur = Arthur(aur_url=aur_url)
+        sync_index(self.arthur.sync_root)
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.active = {}
+        self.queued = {}
+        self.timers = []
+        self.addresses = {}
+        self.working = 0
+        self.finished = Queue.Queue()
+        self.wakeup = os.pipe()
+
+    def get(self, url, headers=None, timeout=None):
+        """Return a Future of (status, headers, body) for url"""
+        return self._get(url, headers, timeout or self.timeout)
+
+    @coroutine
+    def _get(self, url, headers, timeout):
+        for redirect in range(self.max_redirects + 1):
+            for attempt in range(self.retries + 1):
+                request = AsyncRequest(url, headers, time.time() + timeout)
+                try:
+                    request.address = yield self.lookup(request.host,
+                                                        request.port)
+                    self.queued.setdefault(request.key, []).append(request)
+                    self._start(request.key)
+                    status, reason, response_headers, body = \
+                        yield request.future
+                except NetworkError:
+                    if attempt == self.retries:
+                        raise
+                    yield self.sleep(self.backoff * 2 ** attempt)
+                    continue
+                if status not in self.retry_statuses or \
+                        attempt == self.retries:
+                    break
+                retry_after = response_headers.get('retry-after', '')
+                yield self.sleep(int(retry_after) if retry_after.isdigit()
+                                 else self.backoff * 2 ** attempt)
+            location = response_headers.get('location')
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status >= 400:
+                raise HTTPError(url, status, reason)
+            raise Return((status, response_headers, body))
+        raise NetworkError('%s: too many redirects' % url)
+
+    def sleep(self, seconds):
+        """Return a Future that is done after seconds"""
+        future = Future()
+        heapq.heappush(self.timers, (time.time() + seconds, future))
+        return future
+
+    def in_thread(self, func, *args):
+        """Return a Future of func(*args) run in a worker thread"""
+        future = Future()
+
+        def work():
+            try:
+                result = (func(*args), None)
+            except Exception, e:
+                result = (None, e)
+            self.finished.put((future,) + result)
+            os.write(self.wakeup[1], '.')
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        self.working += 1
+        thread.start()
+        return future
+
+    def lookup(self, host, port):
+        """Return a Future of the address of host, looked up once"""
+        key = (host, port)
+        if key not in self.addresses:
+            def getaddrinfo():
+                try:
+                    return socket.getaddrinfo(host, port, 0,
+                                              socket.SOCK_STREAM)[0]
+                except socket.error, e:
+                    raise NetworkError('%s: %s' % (host, e))
+
+            def forget(future):
+                if future.exception() is not None:
+                    del self.addresses[key]
+            self.addresses[key] = self.in_thread(getaddrinfo)
+            self.addresses[key].add_done_callback(forget)
+        return self.addresses[key]
+
+    def _start(self, key):
+        """Start queued requests to key while it has free slots"""
+        active = self.active.setdefault(key, [])
+        queued = self.queued.get(key)
+        while queued and len(active) < self.per_host:
+            request = queued.pop(0)
+            try:
+                request.start(request.address)
+            except socket.error, e:
+                request.close()
+                request.future.set_exception(
+                    NetworkError('%s: %s' % (request.url, e)))
+                continue
+            active.append(request)
+
+    def _finish(self, request, response=None, error=None):
+        request.close()
+        self.active[request.key].remove(request)
+        self._start(request.key)
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(response)
+
+    def pending(self):
+        """Return whether any request or timer is outstanding"""
+        return bool(self.timers or self.working or
+                    any(self.active.values()) or any(self.queued.values()))
+
+    def poll(self, timeout=0.0):
+        """Wait up to timeout seconds for socket events and handle them"""
+        requests = [request for active in self.active.values()
+                    for request in active]
+        now = time.time()
+        if self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - now))
+        reading = [r for r in requests if r.readable()]
+        writing = [r for r in requests if r.writable()]
+        if self.working:
+            reading.append(self.wakeup[0])
+        if reading or writing:
+            try:
+                readable, writable, broken = select.select(reading, writing,
+                                                           [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = writable = []
+        else:
+            time.sleep(timeout)
+            readable = writable = []
+        if self.wakeup[0] in readable:
+            os.read(self.wakeup[0], 4096)
+            readable.remove(self.wakeup[0])
+        while not self.finished.empty():
+            future, result, error = self.finished.get()
+            self.working -= 1
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        for ready, handle in ((writable, 'on_writable'),
+                              (readable, 'on_readable')):
+            for request in ready:
+                if request.future.done() or request.sock is None:
+                    continue
+                try:
+                    response = getattr(request, handle)()
+                except ArthurError, e:
+                    self._finish(request, error=e)
+                except (socket.error, zlib.error, ValueError), e:
+                    self._finish(request, error=NetworkError(
+                        '%s: %s' % (request.url, e)))
+                else:
+                    if response is not None:
+                        self._finish(request, response)
+        now = time.time()
+        for request in requests:
+            if not request.future.done() and now > request.deadline:
+                self._finish(request, error=Timeout('%s: timed out' %
+                                                    request.url))
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[1].set_result(None)
+
+    def close(self):
+        """Close open connections and the pipe that wakes poll()"""
+        for active in self.active.values():
+            for request in active:
+                request.close()
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def run(self, future=None):
+        """Drive the client until future is done, or until nothing is
+        pending; return the result of future"""
+        while (future is None or not future.done()) and self.pending():
+            self.poll(0.1)
+        if future is not None:
+            return future.result()
+
+    @coroutine
+    def rpc(self, type, arg=None):
+        """Return a Future of the results of an rpc request"""
+        status, headers, body = yield self.get(self.arthur.url(type, arg))
+        try:
+            response = json.loads(body)
+        except ValueError, e:
+            raise RPCError('%s: bad response: %s' % (type, e))
+        if response.get('type') == 'error':
+            raise RPCError('%s: %s' % (arg, response['results']))
+        raise Return(response['results'])
+
+    @coroutine
+    def search(self, term, title=False):
+        """Return a Future of the packages matching term"""
+        results = yield self.rpc('search', term)
+        if title:
+            results = [p for p in results if term in p['Name']]
+        raise Return(results)
+
+    @coroutine
+    def multiinfo(self, names):
+        """Return a Future of a dict of the info of the packages in names
+        that are in the AUR"""
+        found = {}
+        chunks = yield [self.rpc('multiinfo', chunk)
+                        for chunk in self.arthur.chunks(names)]
+        for packages in chunks:
+            for package in packages:
+                found[package['Name']] = package
+        raise Return(found)
+
+    @coroutine
+    def info(self, name):
+        """Return a Future of the info of package name"""
+        found = yield self.multiinfo([name])
+        if name not in found:
+            raise PackageNotFound(name)
+        raise Return(found[name])
+
+    @coroutine
+    def dependencies(self, package):
+        """Return a Future of the repo and AUR dependencies of a package
+        given its info"""
+        status, headers, body = yield self.get(
+            self.arthur.aur(package['URLPath']))
+        # xz and zstd tarballs are read by a subprocess, so off the loop
+        sources = yield self.in_thread(read_members,
+                                       cStringIO.StringIO(body))
+        if 'PKGBUILD' not in sources:
+            raise ArthurError('%s: no PKGBUILD in %s' % (package['Name'],
+                                                        package['URLPath']))
+        raise Return(self.arthur.classify(
+            source_metadata(sources, package['Name'])))
+
+    @coroutine
+    def resolve(self, names):
+        """Return a Future of the build order of names and their AUR
+        dependencies and of the repo packages they need, like deps"""
+        resolver = Resolver(None, None)
+        for missing in resolver.levels(names):
+            found = yield self.multiinfo(missing)
+            dependencies = yield [self.dependencies(package) for package in
+                                  resolver.packages(missing, found)]
+            for name, deps in zip(missing, dependencies):
+                resolver.add(name, *deps)
+        plan = resolver.plan(names)
+        raise Return({'build': plan,
+                      'repo': resolver.pacman_dependencies(plan)})
+
+
+class ThreadStreams(object):
+    """Stand-in for sys.stdout or sys.stderr writing to a stream set per
+    thread, so that commands run by the server write to their client"""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def __getattr__(self, attr):
+        return getattr(getattr(self.local, 'stream', None) or self.default,
+                       attr)
+
+
+class ClientStream(object):
+    """File-like writer sending one channel of a command's output to the
+    client as frames"""
+
+    def __init__(self, sock, channel, tty=False):
+        self.sock = sock
+        self.channel = channel
+        self.tty = tty
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        if data:
+            send_frame(self.sock, self.channel, data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.tty
+
+
+def send_frame(sock, kind, data):
+    """Send data as a frame: a kind byte, the length and a newline"""
+    sock.sendall('%s%d\n%s' % (kind, len(data), data))
+
+def read_frames(fileobj):
+    """Yield (kind, data) for every frame read from fileobj"""
+    while True:
+        header = fileobj.readline()
+        if not header:
+            return
+        data = fileobj.read(int(header[1:]))
+        yield header[0], data
+
+def socket_path():
+    return join(os.getenv('XDG_RUNTIME_DIR') or cache_dir(), 'arthur.sock')
+
+# commands the server answers, and batch runs
+served = ('search', 'info', 'deps')
+
+def run_command(argv):
+    """Dispatch argv in this process and return its exit status"""
+    try:
+        result = opster.dispatch(list(argv), dict(cmds), list(global_options),
+                                 middleware)
+    except SystemExit, e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write('%s\n' % e.code)
+        return 1
+    return result if isinstance(result, int) else 0
+
+def handle_client(sock):
+    """Run the command a client sent and stream its output back"""
+    try:
+        kind, data = next(read_frames(sock.makefile('rb')))
+        request = json.loads(data)
+        argv = [arg.encode('utf8') for arg in request['argv']]
+        if not argv or argv[0] not in served:
+            send_frame(sock, 'e', 'arthur serve: cannot run %s\n' %
+                       ' '.join(argv))
+            send_frame(sock, 'x', '1')
+            return
+        sys.stdout.set(ClientStream(sock, 'o', request.get('tty')))
+        sys.stderr.set(ClientStream(sock, 'e', request.get('tty')))
+        try:
+            code = run_command(argv)
+        except Exception:
+            # a crash in one command must not cost the client its answer
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.set(None)
+            sys.stderr.set(None)
+        send_frame(sock, 'x', str(code))
+    except (socket.error, ValueError, StopIteration):
+        pass  # the client went away or spoke nonsense
+    finally:
+        sock.close()
+
+def forward(argv):
+    """Run argv in a running server, writing out its output; return the
+    exit status, or None when no server is listening"""
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(path)
+        send_frame(sock, 'a', json.dumps({'argv': argv,
+                                          'tty': sys.stdout.isatty()}))
+        for kind, data in read_frames(sock.makefile('rb')):
+            if kind == 'x':
+                return int(data)
+            stream = sys.stdout if kind == 'o' else sys.stderr
+            stream.write(data)
+            stream.flush()
+    except socket.error, e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return None  # a stale socket
+        sys.exit('arthur serve: %s' % e)
+    finally:
+        sock.close()
+    sys.exit('arthur serve: connection lost')
+
+def forwardable(argv):
+    """Return whether argv is a command the server can answer for us"""
+    command = next((arg for arg in argv if not arg.startswith('-')), None)
+    if command not in served or '--no-server' in argv:
+        return False
+    # traces are of the process that ran the command
+    if any(arg.startswith('--trace') for arg in argv):
         return False
+    # --debug reads cache.json from the working directory
+    return not any(arg == '--debug' or
+                   (arg[:1] == '-' and arg[1:2] != '-' and 'd' in arg)
+                   for arg in argv)
+
+
+# options of every command that talks to the aur
+network_options = [
+    ('', 'timeout', 30, 'seconds to wait for the aur to respond'),
+    ('', 'retries', 3, 'times to retry failed requests to the aur'),
+    ('', 'rate', '', 'requests a second allowed to each aur host'
+                     ' (default: no limit)'),
+]
+# and of those that read rpc responses through the cache
+rpc_options = [
+    ('o', 'offline', False, 'only use cached aur responses'),
+    ('r', 'refresh', False, 'revalidate cached aur responses'),
+] + network_options
 
 def search(*args, **opts):
     """Search the AUR for PACKAGE"""
@@ -241,13 +3781,23 @@ def search(*args, **opts):
         Arthur(term=args, **opts).search()
     else:
         usage = __file__ + ' search ' + search_usage
-        help_cmd(search, usage, search_options)
+        opster.help_cmd(search, usage, search_options)
 
 search_options = [
     ('v', 'verbose', False, 'verbose output'),
     ('d', 'debug', False, 'do not actually query aur'),
     ('t', 'title', False, 'only query on package title; ignore the description'),
-]
+    ('f', 'format', 'text', 'output format: text, json (one object per line)'
+                            ' or tsv'),
+    ('', 'fields', '', 'comma separated fields written by json and tsv'),
+    ('s', 'sort', 'Name', 'field to sort results by; empty to stream them'
+                          ' unsorted'),
+    ('l', 'local', False, 'search the local package index made by'
+                          ' sync-index'),
+    ('x', 'regex', False, 'PACKAGE is a regular expression (local)'),
+    ('', 'prefix', False, 'match names starting with PACKAGE (local)'),
+    ('w', 'words', False, 'PACKAGE is a full text query (local)'),
+] + rpc_options
 search_usage = '[options] PACKAGE'
 
 def install(*args, **opts):
@@ -256,22 +3806,381 @@ def install(*args, **opts):
         Arthur(term=args, **opts).install()
     else:
         usage = __file__ + ' install ' + install_usage
-        help_cmd(install, usage, install_options)
+        opster.help_cmd(install, usage, install_options)
 
 install_options = [
     ('v', 'verbose', False, 'verbose output'),
     ('d', 'debug', False, 'do not actually query aur'),
     ('p', 'path', False, 'path to pkgbuil archive'),
-]
+    ('j', 'jobs', 4, 'number of packages to fetch and build at once'),
+    ('b', 'builddir', '.', 'directory to put build trees in'),
+    ('n', 'no-build', False, 'only show the dependencies; build nothing'),
+] + rpc_options
 install_usage = '[options] PACKAGE'
 
+def cache(*args, **opts):
+    """show or prune the download and source caches"""
+    store = Store()
+    if opts['max_size']:
+        store.set_limit(opts['max_size'] * 1024 * 1024)
+    if opts['prune']:
+        print 'dropped %d source tarballs' % store.gc()
+    rpc = ResponseCache()
+    responses = glob.glob(join(rpc.path, '*.body'))
+    print 'rpc responses: %d (%.1f MB)' % (
+        len(responses), sum(map(os.path.getsize, responses)) / 1048576.0)
+    stats = store.stats()
+    stats['size'] /= 1048576.0
+    stats['tree_size'] /= 1048576.0
+    stats['max_size'] /= 1048576
+    print ('source tarballs: %(objects)d for %(packages)d package versions '
+           '(%(size).1f MB)' % stats)
+    print 'build trees: %(trees)d (%(tree_size).1f MB)' % stats
+    print 'store size limit: %(max_size)d MB' % stats
+
+cache_options = [
+    ('p', 'prune', False, 'drop least recently used sources above the size'
+                          ' limit'),
+    ('m', 'max-size', 0, 'set the size limit of the source store in MB'
+                         ' (default: 1024), kept for later runs'),
+]
+cache_usage = '[options]'
+
+
+def deps(*args, **opts):
+    """show the build order and repo dependencies of PACKAGES"""
+    if args:
+        Arthur(**opts).deps(args)
+    else:
+        usage = __file__ + ' deps ' + deps_usage
+        opster.help_cmd(deps, usage, deps_options)
+
+deps_options = [
+    ('v', 'verbose', False, 'verbose output'),
+    ('j', 'jobs', 4, 'number of packages to fetch at once'),
+    ('f', 'format', 'text', 'output format: text or json'),
+] + rpc_options
+deps_usage = '[options] PACKAGE...'
+
+def info(*args, **opts):
+    """show the AUR info of PACKAGES"""
+    if args:
+        Arthur(**opts).info(args)
+    else:
+        usage = __file__ + ' info ' + info_usage
+        opster.help_cmd(info, usage, info_options)
+
+info_options = [
+    ('v', 'verbose', False, 'verbose output'),
+    ('f', 'format', 'text', 'output format: text, json (one object per line)'
+                            ' or tsv'),
+    ('', 'fields', '', 'comma separated fields written by json and tsv'),
+] + rpc_options
+info_usage = '[options] PACKAGE...'
+
+def outdated(*args, **opts):
+    """list the installed AUR packages that have a newer version"""
+    Arthur(**opts).outdated()
+
+outdated_options = [
+    ('v', 'verbose', False, 'verbose output'),
+    ('f', 'format', 'text', 'output format: text or json'),
+    ('j', 'jobs', 4, 'number of requests to make at once'),
+] + rpc_options
+outdated_usage = '[options]'
+
+def serve(*args, **opts):
+    """answer search, info and deps from one process with warm caches"""
+    path = opts['socket'] or socket_path()
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+            sys.exit('already serving on %s' % path)
+        except socket.error:
+            os.remove(path)  # left behind by a server that died
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX)
+    # create the socket private rather than chmod it after a window
+    umask = os.umask(0077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    # load what every request needs up front; the terminal while stdout is
+    # still the real one
+    for warm in (colour_map, lambda: sync_index(Arthur.sync_root),
+                 name_index):
+        try:
+            warm()
+        except (ArthurError, EnvironmentError):
+            pass
+    sys.stdout = ThreadStreams(sys.stdout)
+    sys.stderr = ThreadStreams(sys.stderr)
+    print 'serving on %s' % path
+    sys.stdout.flush()
+    try:
+        while True:
+            sock, address = listener.accept()
+            thread = threading.Thread(target=handle_client, args=(sock,))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(path)
+
+serve_options = [
+    ('s', 'socket', '', 'unix socket to listen on (default: '
+                        '$XDG_RUNTIME_DIR/arthur.sock)'),
+]
+serve_usage = '[options]'
+
+def run_batched(line):
+    """Run one line of a batch; return its status, output and errors"""
+    out = cStringIO.StringIO()
+    err = cStringIO.StringIO()
+    try:
+        argv = shlex.split(line)
+    except ValueError, e:
+        return 1, '', '%s: %s\n' % (line, e)
+    if argv[0] not in served:
+        return 1, '', 'arthur batch: cannot run %s\n' % argv[0]
+    sys.stdout.set(out)
+    sys.stderr.set(err)
+    try:
+        code = run_command(argv)
+    except ArthurError, e:
+        err.write('%s\n' % e)
+        code = 1
+    except Exception:
+        # a crash fails its own line, not the rest of the batch
+        err.write(traceback.format_exc())
+        code = 1
+    finally:
+        sys.stdout.set(None)
+        sys.stderr.set(None)
+    return code, out.getvalue(), err.getvalue()
+
+def batch(*args, **opts):
+    """run the search, info and deps lines of FILE or stdin in one process"""
+    path = args[0] if args else '-'
+    try:
+        fileobj = sys.stdin if path == '-' else open(path)
+    except IOError, e:
+        sys.exit('%s: %s' % (path, e.strerror))
+    lines = [line.strip() for line in fileobj]
+    lines = [line for line in lines if line and not line.startswith('#')]
+    if opts['format'] not in ('text', 'json'):
+        sys.exit('unknown format: %s' % opts['format'])
+    formatter = OutputFormatter()
+    streams = sys.stdout, sys.stderr
+    sys.stdout = ThreadStreams(sys.stdout)
+    sys.stderr = ThreadStreams(sys.stderr)
+    failed = 0
+    try:
+        # run a window of lines at a time so output keeps coming, in order
+        jobs = max(opts['jobs'], 1)
+        window = jobs * 16
+        for start in range(0, len(lines), window):
+            chunk = lines[start:start + window]
+            results = pool_map(run_batched, chunk, jobs)
+            for line, (code, out, err) in zip(chunk, results):
+                failed += code != 0
+                if opts['format'] == 'json':
+                    formatter.write(json.dumps({
+                        'command': line, 'status': code,
+                        'stdout': out.decode('utf8', 'replace'),
+                        'stderr': err.decode('utf8', 'replace')}) + '\n')
+                    continue
+                formatter('==>', fg='yellow', separator=' ')
+                formatter(line)
+                formatter.write(out)
+                if err:
+                    formatter.flush()
+                    streams[1].write(err)
+                if code:
+                    formatter('==>', fg='red', separator=' ')
+                    formatter('exit status %d' % code)
+            formatter.flush()
+    finally:
+        sys.stdout, sys.stderr = streams
+    if failed:
+        sys.exit(1)
+
+batch_options = [
+    ('j', 'jobs', 1, 'number of commands to run at once'),
+    ('f', 'format', 'text', 'output format: text, or json with one object'
+                            ' per command'),
+]
+batch_usage = '[options] [FILE]'
+
+def update_index(*args, **opts):
+    """build the local package index from the AUR or a DUMP file"""
+    Arthur(**opts).update_index(args[0] if args else None)
+
+update_index_options = network_options
+update_index_usage = '[options] [DUMP]'
+
+def completion_table(cmdtable):
+    """Return the command names and options of cmdtable for completion
+
+    Maps every command name and alias to a list of ``(short, long, takes
+    argument)`` for its options.
+    """
+    table = {'help': [('h', 'help', False)]}
+    for key, (func, options, usage) in cmdtable.items():
+        flags = [('h', 'help', False)] + [
+            (short, name, not isinstance(default, bool))
+            for short, name, default, help in global_options + options]
+        for name in key.lstrip('^').split('|'):
+            table[name] = flags
+    return table
+
+def load_completion(name, source, build):
+    """Return the marshalled completion data in name, calling build to
+    remake it when it is older than source"""
+    path = join(cache_dir('completion'), name)
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(source):
+            with open(path, 'rb') as f:
+                return marshal.load(f)
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        pass
+    data = build()
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        marshal.dump(data, f)
+    os.rename(tmp, path)
+    return data
+
+def completions(words):
+    """Return the completions of the last of words, the arguments of an
+    arthur command line being typed"""
+    current = words[-1] if words else ''
+    table = load_completion('commands', os.path.splitext(__file__)[0] + '.py',
+                            lambda: completion_table(cmds))
+    if len(words) <= 1:
+        return sorted(name for name in table if name.startswith(current))
+    flags = table.get(words[0])
+    if flags is None:
+        # a unique prefix of a command runs it too
+        matches = [name for name in table if name.startswith(words[0])]
+        flags = table[matches[0]] if len(matches) == 1 else []
+    if current.startswith('-'):
+        options = (['--' + name for short, name, arg in flags] +
+                   ['-' + short for short, name, arg in flags if short])
+        return sorted(option for option in options
+                      if option.startswith(current))
+    previous = words[-2]
+    if any(previous in ('-' + short, '--' + name)
+           for short, name, arg in flags if arg):
+        return []
+    if words[0] == 'help':
+        return sorted(name for name in table if name.startswith(current))
+    if words[0] in ('cache', 'sync-index'):
+        return []
+    index = LocalIndex()
+    if not os.path.exists(index.path):
+        return []
+    return prefixed(load_completion('names', index.path, index.names),
+                    current)
+
+# bash glue; imports arthur rather than running it to use its compiled code
+complete_script = """_arthur() {
+    COMPREPLY=($(%s -c 'import sys; sys.path.insert(0, sys.argv[1])
+import arthur; arthur.complete_main(sys.argv[2:])' %s \\
+        "${COMP_WORDS[@]:1:COMP_CWORD}"))
+}
+complete -o default -F _arthur arthur arthur.py
+"""
+
+def complete_main(words):
+    """Write the completions of words, one per line"""
+    result = completions([word.decode('utf8') for word in words])
+    sys.stdout.write(''.join(word.encode('utf8') + '\n' for word in result))
+
+def complete(*words, **opts):
+    """complete the arthur command line WORDS, the last being completed"""
+    if opts['script']:
+        sys.stdout.write(complete_script % (
+            sys.executable, os.path.dirname(os.path.abspath(__file__))))
+    else:
+        complete_main(words or [''])
+
+complete_options = [
+    ('s', 'script', False, 'print a bash completion script using this'),
+]
+complete_usage = '[options] -- WORDS...'
+
 
 cmds = {
     '^search': (search, search_options, search_usage),
-    '^install': (install, install_options, install_usage)
+    '^install': (install, install_options, install_usage),
+    'cache': (cache, cache_options, cache_usage),
+    'sync-index': (update_index, update_index_options, update_index_usage),
+    'complete': (complete, complete_options, complete_usage),
+    'deps': (deps, deps_options, deps_usage),
+    'info': (info, info_options, info_usage),
+    'outdated': (outdated, outdated_options, outdated_usage),
+    'serve': (serve, serve_options, serve_usage),
+    'batch': (batch, batch_options, batch_usage),
 }
 
+global_options = [
+    ('', 'profile-startup', False, 'report how long importing each module'
+                                   ' took'),
+    ('', 'no-server', False, 'do not hand the command to a running arthur'
+                             ' serve'),
+    ('', 'trace', '', 'time what the command does: - writes a summary to'
+                      ' stderr, a file name gets Chrome trace events'),
+]
+
+def middleware(func):
+    """Take the global options out and check the shared ones before
+    running a command"""
+    def inner(*args, **opts):
+        opts.pop('profile_startup', None)
+        opts.pop('no_server', None)
+        trace = opts.pop('trace', '')
+        if opts.get('rate'):
+            try:
+                rate = float(opts['rate'])
+            except ValueError:
+                rate = 0
+            if not rate > 0:
+                sys.exit('--rate: %s is not a number of requests a second'
+                         % opts['rate'])
+        if import_timer:
+            import_timer.ready = time.time()
+        if not trace:
+            return func(*args, **opts)
+        global tracer
+        tracer = Tracer()
+        try:
+            with span(func.__name__):
+                return func(*args, **opts)
+        finally:
+            if trace == '-':
+                tracer.summary()
+            else:
+                with open(trace, 'w') as out:
+                    tracer.chrome(out)
+            tracer = None
+    return inner
+
 if __name__ == "__main__":
+    if import_timer:
+        import atexit
+        atexit.register(import_timer.report)
+    if forwardable(sys.argv[1:]):
+        status = forward(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
     # let's go
-    dispatch(cmdtable=cmds)
+    opster.dispatch(cmdtable=cmds, globaloptions=list(global_options),
+                    middleware=middleware)
 
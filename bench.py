@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+"""Benchmarks for arthur
+
+Every benchmark runs offline, against the fixtures in ``samples/`` and
+``cache.json`` or against synthetic sync databases and AUR trees served by
+a local HTTP stand-in. Results can be written as JSON, saved as a baseline
+and compared with one.
+"""
+from opster import command
+import BaseHTTPServer
+import SocketServer
+import difflib
+import glob
+import io
+import json
+import os.path
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urlparse
+from itertools import chain
+from os.path import join
+
+import arthur
+
+here = os.path.dirname(os.path.abspath(__file__))
+samples = join(here, 'samples')
+
+benchmarks = []
+
+def benchmark(func):
+    """Register func as a benchmark"""
+    benchmarks.append(func)
+    return func
+
+def best(func, repeat=5, number=1000):
+    """Return the best time in seconds of one call of func"""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            func()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+def corpus():
+    """Return (text, is_srcinfo) for every sample PKGBUILD and .SRCINFO"""
+    return [(open(path).read(), path.endswith('.SRCINFO'))
+            for path in sorted(glob.glob(join(samples, 'pkgbuilds', '*')))]
+
+def regex_dependencies(pkgbuild):
+    """The dependency scan find_dependencies used before parse_metadata"""
+    depends = re.findall('[^opt](?:make)?depends=\((.*?)\)', pkgbuild, re.S)
+    depends = chain(*[de.split() for de in depends])
+    depends = (de.strip("'") for de in depends if de != '\\')
+    return [re.match('(.[^=><]*)', dep).group() for dep in depends]
+
+
+@benchmark
+def parse_dependencies(number):
+    """PKGBUILD parsing: old regex scan vs parse_metadata, cold and memoized"""
+    texts = corpus()
+
+    def regex():
+        for text, srcinfo in texts:
+            regex_dependencies(text)
+
+    def cold():
+        arthur._metadata.clear()
+        for text, srcinfo in texts:
+            arthur.parse_metadata(text, srcinfo)
+
+    def memoized():
+        for text, srcinfo in texts:
+            arthur.parse_metadata(text, srcinfo)
+
+    return [('regex', best(regex, number=number), 's'),
+            ('parser', best(cold, number=number), 's'),
+            ('parser memoized', best(memoized, number=number), 's')]
+
+
+def scaled_search(path, factor):
+    """Write cache.json with its results repeated factor times to path"""
+    response = json.load(open(join(here, 'cache.json')))
+    response['results'] = response['results'] * factor
+    with open(path, 'w') as f:
+        json.dump(response, f)
+
+# run in a fresh interpreter so that peak RSS covers one decode only
+decode_child = """
+import resource, sys, time
+start = time.time()
+import arthur, json
+if sys.argv[1] == 'stream':
+    results = iter(arthur.JSONStream(open(sys.argv[2])))
+else:
+    results = iter(json.load(open(sys.argv[2]))['results'])
+results.next()
+first = time.time() - start
+for result in results:
+    pass
+print first, time.time() - start, \\
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+@benchmark
+def decode_results(number):
+    """Search response decoding: json.load vs JSONStream
+
+    Measures time to the first result, time to all results and peak RSS
+    over cache.json scaled up 200 times.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        path = join(tmp, 'search.json')
+        scaled_search(path, 200)
+        results = []
+        for mode in ('load', 'stream'):
+            out = subprocess.Popen([sys.executable, '-c', decode_child, mode,
+                                    path], stdout=subprocess.PIPE,
+                                   cwd=here).communicate()[0]
+            first, total, rss = out.split()
+            results += [('%s first result' % mode, float(first), 's'),
+                        ('%s all results' % mode, float(total), 's'),
+                        ('%s peak rss' % mode, int(rss), 'kB')]
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def scaled_names(factor):
+    """Return the names in cache.json made unique and repeated factor
+    times"""
+    names = [result['Name'] for result in
+             json.load(open(join(here, 'cache.json')))['results']]
+    return ['%s%d' % (name, i) if i else name
+            for i in range(factor) for name in names]
+
+@benchmark
+def name_queries(number):
+    """Name queries: linear scan vs NameIndex
+
+    Runs over the names in cache.json scaled up to about 65k names.
+    """
+    names = scaled_names(200)
+    start = time.time()
+    index = arthur.NameIndex(names)
+    results = [('index build', time.time() - start, 's')]
+    number = max(1, number // 10)
+    for query, term, linear, indexed in [
+            ('substring', 'snipm',
+             lambda: [n for n in names if 'snipm' in n],
+             lambda: index.substring('snipm')),
+            ('prefix', 'vim-s',
+             lambda: [n for n in names if n.startswith('vim-s')],
+             lambda: index.prefix('vim-s')),
+            ('did you mean', 'vim-snipmta',
+             lambda: difflib.get_close_matches('vim-snipmta', names),
+             lambda: index.suggest('vim-snipmta'))]:
+        results += [('%s scan' % query, best(linear, 3, 1), 's'),
+                    ('%s index' % query, best(indexed, 3, number), 's')]
+    return results
+
+
+class Sink(object):
+    """Output stream that throws everything away"""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+@benchmark
+def search_rendering(number):
+    """Search output: cache.json rendered in every format"""
+    count = len(json.load(open(join(here, 'cache.json')))['results'])
+    results = []
+    for format in ('text', 'json', 'tsv'):
+        def render():
+            formatter = arthur.OutputFormatter(stream=Sink())
+            arthur.Arthur(term=['vim'], debug=True, format=format,
+                          formatter=formatter).search()
+        results.append(('%s' % format,
+                        count / best(render, 3, max(1, number // 10)),
+                        'pkg/s'))
+    return results
+
+
+def tarball(files):
+    """Return a gzipped tarball holding files, a dict of path to text"""
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+    for path, text in sorted(files.items()):
+        info = tarfile.TarInfo(path)
+        info.size = len(text)
+        info.mtime = 0
+        tar.addfile(info, io.BytesIO(text))
+    tar.close()
+    return buf.getvalue()
+
+def sync_root(path, repos=('core', 'extra', 'community'), size=3000):
+    """Write sync databases of size packages each below path; package
+    ``<repo>-lib<i>`` provides ``lib<i>.so``"""
+    os.makedirs(path)
+    for repo in repos:
+        files = {}
+        for i in range(size):
+            name = '%s-lib%d' % (repo, i)
+            files['%s-1.0-1/desc' % name] = (
+                '%%NAME%%\n%s\n\n%%VERSION%%\n1.0-1\n\n'
+                '%%PROVIDES%%\n%s-lib%d.so=1\n\n' % (name, repo, i))
+        with open(join(path, repo + '.db'), 'wb') as f:
+            f.write(tarball(files))
+    return path
+
+def use_sync_root(root):
+    arthur.Arthur.sync_root = root
+    arthur._sync_indexes.clear()
+
+@benchmark
+def dependency_parsing(number):
+    """find_dependencies: sample PKGBUILDs parsed and classified"""
+    texts = [text for text, srcinfo in corpus() if not srcinfo]
+    a = arthur.Arthur()
+
+    def cold():
+        arthur._metadata.clear()
+        for text in texts:
+            a.find_dependencies(text)
+
+    def memoized():
+        for text in texts:
+            a.find_dependencies(text)
+
+    return [('cold per PKGBUILD', best(cold, number=number) / len(texts),
+             's'),
+            ('memoized per PKGBUILD',
+             best(memoized, number=number) / len(texts), 's')]
+
+@benchmark
+def sync_lookups(number):
+    """in_sync: sync databases of 9000 packages loaded and queried"""
+    root = arthur.Arthur.sync_root
+    cache = join(arthur.cache_dir(), 'syncdb.json')
+
+    def cold():
+        if os.path.exists(cache):
+            os.remove(cache)
+        use_sync_root(root)
+        arthur.sync_index(root)
+
+    def warm():
+        use_sync_root(root)
+        arthur.sync_index(root)
+
+    results = [('load databases', best(cold, 3, 1), 's'),
+               ('load cached index', best(warm, 3, 1), 's')]
+    a = arthur.Arthur()
+    for label, name in [('lookup by name', 'extra-lib42'),
+                        ('lookup by provides', 'community-lib7.so'),
+                        ('lookup miss', 'no-such-package')]:
+        results.append((label, best(lambda: a.in_sync(name),
+                                    number=number * 10), 's'))
+    return results
+
+
+class StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Just enough of the AUR rpc and package downloads"""
+
+    protocol_version = 'HTTP/1.1'
+    # name -> (info, tarball)
+    packages = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/rpc.php':
+            results = [self.packages[name][0] for name in
+                       query.get('arg[]', []) if name in self.packages]
+            body = json.dumps({'type': 'multiinfo',
+                               'resultcount': len(results),
+                               'results': results})
+        elif url.path.split('/')[2:3] and url.path.split('/')[2] in \
+                self.packages:
+            body = self.packages[url.path.split('/')[2]][1]
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients dropping kept alive connections
+
+def synthetic_tree(levels=6, width=40, fanout=3, seed=0):
+    """Return {name: AUR dependencies}: a root over levels of width
+    packages, each depending on fanout packages of the next level"""
+    rng = random.Random(seed)
+    tree = {'root': ['pkg-0-%d' % i for i in range(width)]}
+    for level in range(levels):
+        for i in range(width):
+            below = ['pkg-%d-%d' % (level + 1, j) for j in
+                     rng.sample(range(width), fanout)]
+            tree['pkg-%d-%d' % (level, i)] = (below if level + 1 < levels
+                                              else [])
+    return tree
+
+def serve_tree(tree, seed=0):
+    """Serve tree from a stand-in on localhost; return the server"""
+    rng = random.Random(seed)
+    packages = {}
+    for name, deps in tree.items():
+        repo = ['%s-lib%d' % (rng.choice(['core', 'extra', 'community']),
+                              rng.randrange(3000)) for i in range(2)]
+        pkgbuild = ('pkgname=%s\npkgver=1.0\npkgrel=1\narch=(any)\n'
+                    'depends=(%s)\nmakedepends=(%s)\n'
+                    'build() {\n  make\n}\n' % (
+                        name, ' '.join("'%s>=1'" % d for d in deps + repo[:1]),
+                        repo[1]))
+        info = {'Name': name, 'Version': '1.0-1', 'NumVotes': 1,
+                'OutOfDate': 0, 'Description': 'synthetic package',
+                'URLPath': '/cgit/%s/%s.tar.gz' % (name, name)}
+        packages[name] = (info, tarball({'%s/PKGBUILD' % name: pkgbuild}))
+    StandIn.packages = packages
+    server = StandInServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+@benchmark
+def resolution(number):
+    """Dependency resolution: 241 synthetic packages from a stand-in
+
+    The tree is served by a local HTTP stand-in; cold runs start from empty
+    caches, warm runs reuse them.
+    """
+    tree = synthetic_tree()
+    server = serve_tree(tree)
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    cache = os.environ['XDG_CACHE_HOME']
+    requests = []
+
+    def resolve(cold):
+        if cold:
+            shutil.rmtree(cache)
+            os.makedirs(cache)
+        a = arthur.Arthur(aur_url=url, jobs=8)
+        issued = a.scheduler.counters['issued']
+        arthur.Resolver(a.multiinfo, a.fetch).resolve(['root'])
+        requests.append(a.scheduler.counters['issued'] - issued)
+
+    results = []
+    try:
+        for label, cold in [('cold', True), ('warm', False)]:
+            del requests[:]
+            results += [('%s resolve' % label,
+                         best(lambda: resolve(cold), 3, 1), 's'),
+                        ('%s requests' % label, requests[-1], 'req')]
+    finally:
+        arthur.http_session().close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def format_value(value, unit):
+    if unit == 's':
+        if value < 1e-3:
+            return '%10.1f us' % (value * 1e6)
+        return '%10.1f ms' % (value * 1e3)
+    return '%10d %s' % (value, unit)
+
+# units where more is better; lower is better for all others
+rates = ('pkg/s',)
+
+def compare(value, unit, baseline):
+    """Describe how value compares with the baseline value"""
+    if not baseline:
+        return ''
+    ratio = float(value) / baseline
+    if unit not in rates and unit != 's':
+        return '%+8.1f%%' % ((ratio - 1) * 100)
+    speedup = ratio if unit in rates else 1 / ratio if ratio else 0
+    return '%7.2fx %s' % (speedup if speedup >= 1 else 1 / speedup,
+                          'faster' if speedup >= 1 else 'slower')
+
+
+@command(options=[('n', 'number', 200, 'iterations per timing'),
+                  ('j', 'json', False, 'write the results as JSON'),
+                  ('s', 'save', '', 'save the results as a baseline to FILE'),
+                  ('c', 'compare', '', 'compare with the baseline in FILE')],
+         usage='%name [options] [BENCHMARK...]')
+def main(*names, **opts):
+    baseline = {}
+    if opts['compare']:
+        baseline = json.load(open(opts['compare']))['results']
+    # keep the caches of the benchmarks away from the user's
+    cache = tempfile.mkdtemp()
+    environ = dict(os.environ)
+    os.environ['XDG_CACHE_HOME'] = cache
+    cwd = os.getcwd()
+    # --debug searches read cache.json from the working directory
+    os.chdir(here)
+    sync = sync_root(join(tempfile.mkdtemp(), 'sync'))
+    use_sync_root(sync)
+    results = {}
+    try:
+        for func in benchmarks:
+            if names and func.__name__ not in names:
+                continue
+            if not opts['json']:
+                print '%s: %s' % (func.__name__, func.__doc__.splitlines()[0])
+                sys.stdout.flush()
+            results[func.__name__] = measured = {}
+            for label, value, unit in func(opts['number']):
+                measured[label] = {'value': value, 'unit': unit}
+                if not opts['json']:
+                    old = baseline.get(func.__name__, {}).get(label, {})
+                    print '  %-24s %s  %s' % (label, format_value(value, unit),
+                                              compare(value, unit,
+                                                      old.get('value')))
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(cache, True)
+        shutil.rmtree(os.path.dirname(sync), True)
+    report = {'python': platform.python_version(),
+              'machine': platform.machine(),
+              'number': opts['number'],
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    if opts['json']:
+        print json.dumps(report, indent=1, sort_keys=True)
+    if opts['save']:
+        with open(opts['save'], 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()